@@ -506,7 +506,7 @@ if __name__=='__main__':
                     # NDPPP has all intervals the same
                     # BBS has a maller interval in the last timeslot which is compensated here
                     if times[-1] - times[-2] < times[-2] - times[-3]: times[-1] = times[-2] + (times[-2] - times[-3])
-                    if 'time' in sf.getAxesNames(): parms['time'] = {'min':np.min(times-0.1), 'max':np.max(times+0.1)}
+                    if 'time' in sf.getAxesNames(): parms['time'] = {'min':np.min(times), 'max':np.max(times), 'tol':0.1}
                     sf.setSelection(**parms)
 
                     # If needed, convert Amp and Phase to Real and Imag
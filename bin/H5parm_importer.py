@@ -32,6 +32,7 @@ if __name__=='__main__':
     opt.add_option('-s', '--solset', help='Solution-set name (default=sol###)', type='string', default=None)
     opt.add_option('-i', '--instrument', help='Name of the instrument table (default=instrument*)', type='string', default='instrument*')
     opt.add_option('-c', '--complevel', help='Compression level from 0 (no compression, fast) to 9 (max compression, slow) (default=5)', type='int', default='5')
+    opt.add_option('-l', '--complib', help='Compression library: zlib, lzo, bzip2, blosc (default=zlib)', type='string', default='zlib')
     (options, args) = opt.parse_args()
 
     # Check options
@@ -45,6 +46,7 @@ if __name__=='__main__':
     
     # Common options
     complevel = options.complevel
+    complib = options.complib
     solsetName = options.solset
 
     input_file = args[1]
@@ -100,4 +102,4 @@ if __name__=='__main__':
     
     # Call the method that creates the h5parm file
     create_h5parm(instrumentdbFiles, antennaFile, fieldFile, skydbFile,
-                  h5parmFile, complevel, solsetName, globaldbFile=globaldbFile,verbose=options.verbose)
+                  h5parmFile, complevel, solsetName, globaldbFile=globaldbFile,verbose=options.verbose, complib=complib)
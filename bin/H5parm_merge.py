@@ -2,6 +2,9 @@
 # -*- coding: utf-8 -*-
 
 # This tool is used to merge multiple H5parm.
+# With -c the solsets of many H5parms (e.g. one per subband) are concatenated along an axis:
+# the output soltabs are allocated with their final shape, then the blocks of the inputs
+# are read in parallel (each job reads one block of one file) and written by this process only.
 
 # Authors:
 # Francesco de Gasperin
@@ -10,26 +13,164 @@ _author = "Francesco de Gasperin (fdg@strw.leidenuniv.nl)"
 import sys, os, glob
 import numpy as np
 import logging
-import pyrap.tables as pt
-import lofar.parmdb
+import tables
 from losoto import _version
 from losoto import _logging
 import losoto.h5parm
+from losoto.h5parm import computeBlockShape, iterBlocks, getChecksums, updateChecksums
+from losoto.operations_lib import multiprocManager
+
+def readBlock(h5parmFile, path, block, outBlock, outQueue):
+    """
+    Read a block ((start, stop) for each axis) of the values and weights of a soltab,
+    outBlock is where it goes in the output soltab
+    """
+    f = tables.open_file(h5parmFile, 'r')
+    try:
+        soltab = f.get_node(path)
+        block = tuple([slice(start, stop) for start, stop in block])
+        outQueue.put([soltab._v_name, outBlock, soltab.val[block], soltab.weight[block]])
+    finally:
+        f.close()
+
+
+def concatenate(inputs, h5parmToFile, solsetTo, axisName, ncpu=1, memory=512):
+    """
+    Concatenate the solsets of a list of (H5parm file, solset) along axisName into a new solset
+    """
+    # collect the soltabs of all the inputs, the files are closed before starting the processes
+    soltabs = {} # name -> list of (file, path, soltype, parmdbType, axesNames, axesVals, dtype, checksums) in input order
+    antenna = None
+    for h5parmFile, solset in inputs:
+        hf = losoto.h5parm.h5parm(h5parmFile)
+        if not solset in hf.getSolsets():
+            logging.critical('Missing solset %s in %s.' % (solset, h5parmFile))
+            return 1
+        ss = hf.getSolset(solset)
+        if antenna is None:
+            antenna = np.asarray(ss.antenna.read()).tostring()
+        elif np.asarray(ss.antenna.read()).tostring() != antenna:
+            logging.warning('The antennas of %s:%s differ from the first input, those of the first input are used.' % (h5parmFile, solset))
+        for soltabName, st in hf.getSoltabs(ss).iteritems():
+            if soltabName in ['antenna', 'source']: continue
+            sf = losoto.h5parm.solFetcher(st)
+            axesNames = sf.getAxesNames()
+            soltabs.setdefault(soltabName, []).append((h5parmFile, st._v_pathname, sf.getType(), st._v_attrs['parmdb_type'], \
+                    axesNames, [sf.getAxisValues(a, ignoreSelection=True) for a in axesNames], st.val.dtype, getChecksums(st.val) is not None))
+        hf.close()
+
+    # check the axes: all identical but the concatenated one, whose values must not overlap
+    layouts = {} # name -> (soltype, parmdbType, axesNames, axesVals, dtype, checksums, [(file, path, offset, shape)])
+    for soltabName, parts in sorted(soltabs.iteritems()):
+        if len(parts) != len(inputs):
+            logging.critical('Soltab %s is not in all the inputs.' % soltabName)
+            return 1
+        h5parmFile, path, soltype, parmdbType, axesNames, axesVals, dtype, checksums = parts[0]
+        # the output has checksums if any input has them
+        checksums = any([part[7] for part in parts])
+        if not axisName in axesNames:
+            logging.warning('Soltab %s has no axis %s, it is copied from %s.' % (soltabName, axisName, h5parmFile))
+            layouts[soltabName] = (soltype, parmdbType, axesNames, axesVals, dtype, checksums, [(h5parmFile, path, 0, [len(v) for v in axesVals])])
+            continue
+        axisIdx = axesNames.index(axisName)
+        for part in parts[1:]:
+            if part[2] != soltype or part[4] != axesNames:
+                logging.critical('Soltab %s has a different type or axes in %s.' % (soltabName, part[0]))
+                return 1
+            for i, a in enumerate(axesNames):
+                if i != axisIdx and not np.array_equal(part[5][i], axesVals[i]):
+                    logging.critical('Soltab %s has different %s values in %s.' % (soltabName, a, part[0]))
+                    return 1
+        parts = sorted(parts, key=lambda part: part[5][axisIdx][0])
+        axisVals = np.concatenate([part[5][axisIdx] for part in parts])
+        if len(axisVals) > 1 and not (np.diff(axisVals) > 0).all():
+            logging.critical('Soltab %s: the %s values of the inputs overlap or are not sorted.' % (soltabName, axisName))
+            return 1
+        files = []
+        offset = 0
+        for part in parts:
+            files.append((part[0], part[1], offset, [len(v) for v in part[5]]))
+            offset += len(part[5][axisIdx])
+        axesVals = list(axesVals)
+        axesVals[axisIdx] = axisVals
+        layouts[soltabName] = (soltype, parmdbType, axesNames, axesVals, dtype, checksums, files)
+
+    # preallocate the output with the final shape and chunking
+    ht = losoto.h5parm.h5parm(h5parmToFile, readonly=False)
+    if solsetTo in ht.getSolsets():
+        logging.critical('Destination solset already exists, quitting.')
+        return 1
+    ssT = ht.makeSolset(solsetName = solsetTo, addTables=False)
+    h5parmFile, solset = inputs[0]
+    hf = losoto.h5parm.h5parm(h5parmFile)
+    for leaf in hf.getSolset(solset)._f_iter_nodes(classname='Leaf'):
+        leaf._f_copy(ssT)
+    hf.close()
+
+    jobs = []
+    for soltabName, (soltype, parmdbType, axesNames, axesVals, dtype, checksums, files) in sorted(layouts.iteritems()):
+        stT = ht.makeSoltab(ssT, soltype, soltabName, axesNames=axesNames, axesVals=axesVals, parmdbType=parmdbType, valDtype=dtype, checksums=checksums)
+        logging.info('Concatenating %i inputs into %s (shape: %s).' % (len(files), stT._v_pathname, str(stT.val.shape)))
+        # blocks follow the chunks of the output, in the order of the output
+        for h5parmFile, path, offset, shape in files:
+            blockShape = computeBlockShape(shape, stT.val.chunkshape, itemsize=dtype.itemsize+2, maxBlockSize=memory*1024*1024)
+            for block in iterBlocks(shape, blockShape):
+                inBlock = [(s.start, s.stop) for s in block]
+                outBlock = [(start+offset, stop+offset) if axesNames[i] == axisName else (start, stop) for i, (start, stop) in enumerate(inBlock)]
+                jobs.append([h5parmFile, path, inBlock, outBlock])
+
+    # parallel readers, this process is the only writer
+    mpm = multiprocManager(ncpu, readBlock)
+    for soltabName, outBlock, vals, weights in mpm.map(iter(jobs)):
+        stT = ht.getSoltab(ssT, soltabName)
+        block = tuple([slice(start, stop) for start, stop in outBlock])
+        stT.val[block] = vals
+        stT.weight[block] = weights
+        updateChecksums(stT.val, list(block), vals)
+        updateChecksums(stT.weight, list(block), weights)
+    mpm.wait()
+
+    for soltabName, layout in sorted(layouts.iteritems()):
+        sw = losoto.h5parm.solWriter(ht.getSoltab(ssT, soltabName))
+        sw.addHistory('MERGE (concatenated %i inputs along %s from %s:%s)' % (len(layout[6]), axisName, inputs[0][0], inputs[0][1]))
+    ht.close()
+    logging.info("Done.")
+    return 0
+
 
 if __name__=='__main__':
     # Options
     import optparse
     opt = optparse.OptionParser(usage='%prog [-v] <H5parm:solset> <H5parm:solset> \n'\
+                            +'%prog [-v] [-n ncpu] -c axis <H5parm:solset> [<H5parm:solset> ...] <H5parm:solset>\n'\
+                            +'With -c the input H5parms can be given as patterns (e.g. "SB*.h5:sol000").\n'\
                             +_author, version='%prog '+_version.__version__)
     opt.add_option('-v', '--verbose', help='Go VERBOSE! (default=False)', action='store_true', default=False)
+    opt.add_option('-c', '--concat', help='Concatenate the input solsets along this axis (e.g. freq or time) into a new solset (default=None)', type='string', default=None)
+    opt.add_option('-n', '--ncpu', help='Number of processes reading the inputs with -c (default=1)', type='int', default=1)
+    opt.add_option('-m', '--memory', help='Maximum memory (MB) used to copy each block of data with -c (default=512)', type='int', default=512)
     (options, args) = opt.parse_args()
 
     # Check options
-    if len(args) != 2:
+    if len(args) < 2 or (options.concat is None and len(args) != 2):
         opt.print_help()
         sys.exit()
     if options.verbose: _logging.setLevel("debug")
 
+    if options.concat is not None:
+        inputs = []
+        for arg in args[:-1]:
+            h5parmFromFile, solsetFrom = arg.split(':')
+            h5parmFromFiles = sorted(glob.glob(h5parmFromFile))
+            if h5parmFromFiles == []:
+                logging.critical("Missing H5parm file "+h5parmFromFile+".")
+                sys.exit(1)
+            inputs += [(f, solsetFrom) for f in h5parmFromFiles]
+        h5parmToFile, solsetTo = args[-1].split(':')
+        logging.info("H5parm origin = %i files (%s ... %s)" % (len(inputs), inputs[0][0], inputs[-1][0]))
+        logging.info("H5parm destination = "+args[-1])
+        sys.exit(concatenate(inputs, h5parmToFile, solsetTo, options.concat, options.ncpu, options.memory))
+
     h5parmFrom = args[0]
     h5parmTo = args[1]
 
@@ -57,6 +198,7 @@ if __name__=='__main__':
     ssT = ht.makeSolset(solsetName = solsetTo, addTables=False)
     # write the soltabs
     ssF._f_copy_children(ssT, recursive=True)
+    losoto.h5parm.clearSharing(ssT)
 
     del hf
 
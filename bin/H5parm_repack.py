@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This tool rewrites an H5parm with a new chunk layout, compression and data type.
+# Since HDF5 never shrinks a file, it also reclaims the space left by deleted soltabs.
+# The checksums of the values and weights, if any, are recomputed for the new chunks.
+
+# Authors:
+# Francesco de Gasperin
+_author = "Francesco de Gasperin (fdg@strw.leidenuniv.nl)"
+
+import sys, os
+import numpy as np
+import logging
+from losoto import _version
+from losoto import _logging
+from losoto.h5parm import h5parm, solFetcher, solWriter, computeChunkShape, computeBlockShape, iterBlocks, updateChecksums, getChecksums, clearSharing
+
+if __name__=='__main__':
+    # Options
+    import optparse
+    opt = optparse.OptionParser(usage='%prog [-v] [-a axes|-i axes] [-c complevel] [-l complib] [-t dtype] <H5parm> [<H5parm out>]\n'\
+            +'If no output file is given the input H5parm is replaced.\n'\
+            +_author, version='%prog '+_version.__version__)
+    opt.add_option('-v', '--verbose', help='Go VERBOSE! (default=False)', action='store_true', default=False)
+    opt.add_option('-a', '--axes', help='Optimize for getValuesIter() returning these axes, e.g. "time,freq" to iterate over ant/pol/dir (default=time,freq)', type='string', default='time,freq')
+    opt.add_option('-i', '--iteraxes', help='Optimize for getValuesIter() iterating over these axes, e.g. "time" for time slices (overrides -a)', type='string', default=None)
+    opt.add_option('-c', '--complevel', help='Compression level from 0 (no compression, fast) to 9 (max compression, slow) (default=5)', type='int', default=5)
+    opt.add_option('-l', '--complib', help='Compression library: zlib, lzo, bzip2, blosc (default=zlib)', type='string', default='zlib')
+    opt.add_option('-t', '--dtype', help='Data type of the values: float64 or float32 (default=same as input)', type='string', default=None)
+    opt.add_option('-m', '--memory', help='Maximum memory (MB) used to copy each block of data (default=512)', type='int', default=512)
+    (options, args) = opt.parse_args()
+
+    # Check options
+    if len(args) not in [1, 2]:
+        opt.print_help()
+        sys.exit()
+    if options.verbose: _logging.setLevel("debug")
+
+    h5parmFile = args[0]
+    if not os.path.isfile(h5parmFile):
+        logging.critical("Missing H5parm file.")
+        sys.exit(1)
+    if len(args) == 2:
+        h5parmOutFile = args[1]
+        tmpFile = None
+    else:
+        h5parmOutFile = h5parmFile+'.repack.tmp'
+        tmpFile = h5parmOutFile
+    if os.path.exists(h5parmOutFile):
+        logging.critical("Output file "+h5parmOutFile+" already exists.")
+        sys.exit(1)
+    if options.dtype is not None and options.dtype not in ['float64','float32']:
+        logging.critical("Data type must be float64 or float32.")
+        sys.exit(1)
+
+    logging.info("H5parm origin = "+h5parmFile)
+    logging.info("H5parm destination = "+h5parmOutFile)
+
+    hf = h5parm(h5parmFile, readonly=True)
+    ht = h5parm(h5parmOutFile, readonly=False, complevel=options.complevel, complib=options.complib)
+
+    for solsetName, ssF in hf.getSolsets().iteritems():
+        ssT = ht.makeSolset(solsetName=solsetName, addTables=False)
+        ssF._v_attrs._f_copy(ssT)
+        # copy antenna/source tables
+        for leaf in ssF._f_iter_nodes(classname='Leaf'):
+            leaf._f_copy(ssT)
+
+        for soltabName, stF in hf.getSoltabs(solset=ssF).iteritems():
+            sf = solFetcher(stF)
+            axesNames = sf.getAxesNames()
+            shape = [sf.getAxisLen(axisName, ignoreSelection=True) for axisName in axesNames]
+            if options.dtype is None: valDtype = stF.val.dtype
+            else: valDtype = np.dtype(options.dtype)
+
+            # chunks span the returned axes and have length 1 along the iterated axes
+            if options.iteraxes is not None:
+                returnAxes = [axisName for axisName in axesNames if not axisName in options.iteraxes.split(',')]
+            else:
+                returnAxes = options.axes.split(',')
+            chunkShape = computeChunkShape(axesNames, shape, itemsize=valDtype.itemsize, returnAxes=returnAxes)
+            logging.info("Repacking "+solsetName+"/"+soltabName+" (chunk shape: "+str(chunkShape)+")")
+
+            stT = ht.makeSoltab(ssT, sf.getType(), soltabName, axesNames=axesNames, \
+                    axesVals=[sf.getAxisValues(axisName, ignoreSelection=True) for axisName in axesNames], \
+                    chunkShape=chunkShape, parmdbType=stF._v_attrs['parmdb_type'], valDtype=valDtype, \
+                    checksums=getChecksums(stF.val) is not None)
+            # keep the soltab attributes, AXES and HISTORY (in the soltab attributes if val was shared, see h5parm.addHistory())
+            stF._v_attrs._f_copy(stT)
+            stF.val.attrs._f_copy(stT.val)
+            stF.weight.attrs._f_copy(stT.weight)
+            clearSharing(stT)
+
+            # stream block by block, blocks are aligned to the new chunks
+            # the checksums of the new chunks (if the input has them) are computed from the copied data
+            blockShape = computeBlockShape(shape, chunkShape, itemsize=valDtype.itemsize+2, maxBlockSize=options.memory*1024*1024)
+            logging.debug("Block shape: "+str(blockShape))
+            for block in iterBlocks(shape, blockShape):
+                vals = stF.val[block]
+                weights = stF.weight[block]
+                stT.val[block] = vals
+                stT.weight[block] = weights
+                updateChecksums(stT.val, list(block), vals)
+                updateChecksums(stT.weight, list(block), weights)
+
+            sw = solWriter(stT)
+            sw.addHistory('REPACK (chunk shape: %s, complevel: %i, complib: %s)' % (chunkShape, options.complevel, options.complib))
+            del sf, sw
+
+    hf.close()
+    ht.close()
+
+    if tmpFile is not None:
+        logging.info("Replacing "+h5parmFile+" (%.1f MB -> %.1f MB)" % \
+                (os.path.getsize(h5parmFile)/1024.**2, os.path.getsize(tmpFile)/1024.**2))
+        os.rename(tmpFile, h5parmFile)
+
+    logging.info("Done.")
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This tool checks the values and weights of an H5parm against the checksums of their blocks.
+# Blocks are checked in parallel, each process reads its blocks from the file.
+
+# Authors:
+# Francesco de Gasperin
+_author = "Francesco de Gasperin (fdg@strw.leidenuniv.nl)"
+
+import sys, os
+import numpy as np
+import logging
+import tables
+from losoto import _version
+from losoto import _logging
+from losoto.h5parm import h5parm, getChecksums, computeChecksums, verifyChecksums
+from losoto.operations_lib import multiprocManager
+
+def verifyBlocks(h5parmFile, path, first, last, outQueue):
+    """
+    Check the blocks from first to last (in C order) of an array
+    """
+    f = tables.open_file(h5parmFile, 'r')
+    try:
+        node = f.get_node(path)
+        shape = getChecksums(node).shape
+        blocks = [np.unravel_index(i, shape) for i in xrange(first, last)]
+        outQueue.put([path, last-first, verifyChecksums(node, blocks)])
+    finally:
+        f.close()
+
+
+if __name__=='__main__':
+    # Options
+    import optparse
+    opt = optparse.OptionParser(usage='%prog [-v] [-n ncpu] [-u] <H5parm> \n'\
+            +_author, version='%prog '+_version.__version__)
+    opt.add_option('-v', '--verbose', help='Go VERBOSE! (default=False)', action='store_true', default=False)
+    opt.add_option('-n', '--ncpu', help='Number of processes (default=1)', type='int', default=1)
+    opt.add_option('-u', '--update', help='Compute the checksums of the soltabs which do not have them (default=False)', action='store_true', default=False)
+    (options, args) = opt.parse_args()
+
+    # Check options
+    if len(args) != 1:
+        opt.print_help()
+        sys.exit()
+    if options.verbose: _logging.setLevel("debug")
+
+    h5parmFile = args[0]
+    if not os.path.isfile(h5parmFile):
+        logging.critical("Missing H5parm file.")
+        sys.exit(1)
+
+    # list the arrays to check, the file is closed before starting the processes
+    H = h5parm(h5parmFile, readonly=not options.update)
+    arrays = []
+    for solsetName in sorted(H.getSolsets().keys()):
+        for soltabName, soltab in sorted(H.getSoltabs(solsetName).iteritems()):
+            if soltabName in ['antenna', 'source']: continue
+            for name in ['val', 'weight']:
+                node = soltab._f_get_child(name)
+                if getChecksums(node) is None:
+                    if not options.update:
+                        logging.warning("No checksums for %s (use -u to compute them)." % node._v_pathname)
+                        continue
+                    logging.info("Computing checksums for %s." % node._v_pathname)
+                    computeChecksums(node)
+                arrays.append((node._v_pathname, int(np.prod(getChecksums(node).shape))))
+    H.close()
+
+    # jobs of about the same number of blocks, a few per process
+    nBlocks = sum([size for path, size in arrays])
+    jobBlocks = max(1, nBlocks/(4*max(1, options.ncpu)))
+    mpm = multiprocManager(options.ncpu, verifyBlocks)
+    for path, size in arrays:
+        for first in xrange(0, size, jobBlocks):
+            mpm.put([h5parmFile, path, first, min(first+jobBlocks, size)])
+    mpm.wait()
+
+    checked = dict([(path, 0) for path, size in arrays])
+    bad = dict([(path, []) for path, size in arrays])
+    for path, n, badBlocks in mpm.get():
+        checked[path] += n
+        bad[path] += badBlocks
+
+    errors = 0
+    for path, size in arrays:
+        if bad[path] != []:
+            logging.error("%s: %i of %i blocks do not match their checksums: %s" % (path, len(bad[path]), size, sorted(bad[path])))
+            errors += len(bad[path])
+        else:
+            logging.info("%s: %i blocks OK." % (path, checked[path]))
+
+    if errors > 0:
+        logging.error("Found %i corrupted blocks." % errors)
+        sys.exit(1)
+    logging.info("Done.")
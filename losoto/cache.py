@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# On-disk cache of the results of deterministic operations, keyed by the content of their input
+
+import os
+import logging
+import hashlib
+import json
+import tables
+import numpy as np
+from losoto import _version
+from losoto.h5parm import getWorkingSet, clearSharing
+from losoto.operations_lib import getParSoltabs
+from losoto.scheduler import stepAccess
+from losoto.journal import parsetHash, soltabHash
+
+# operations whose results are cached: they create soltabs or (FLAG) modify their soltabs in place
+cacheOps = ['CLOCKTEC', 'FARADAY', 'FLAG', 'TECFIT', 'TECSCREEN']
+
+class resultCache( object ):
+    """
+    Soltabs created or modified by a step, stored in a directory with one HDF5 file per result.
+    The key is the hash of the operation, its parset options, the content of its input soltabs
+    (with the antenna and source tables of their solsets), the names of the existing soltabs
+    (which decide the names of the new ones) and the LoSoTo version.
+    The least recently used results are removed when the directory exceeds maxSize.
+    """
+
+    def __init__(self, cacheDir, maxSize):
+        """
+        Keyword arguments:
+        cacheDir -- directory of the cache (created if missing)
+        maxSize -- maximum size of the cache in MB
+        """
+        self.cacheDir = os.path.expanduser(cacheDir)
+        self.maxSize = maxSize
+        if not os.path.isdir(self.cacheDir): os.makedirs(self.cacheDir)
+        self.hits = 0
+        self.misses = 0
+        # the size may have been reduced since the last run
+        self._evict()
+
+    def _soltabs(self, H):
+        return ['/'.join([solset, soltab]) for solset in H.getSolsets() for soltab in H.getSoltabs(solset) \
+                    if not soltab in ['antenna', 'source']]
+
+    def _access(self, step, op, parset, H):
+        """
+        Return the soltabs read and written in place by a step
+        """
+        access = stepAccess( step, op, parset, H )
+        if access is None: return set(getParSoltabs( step, parset, H )), set()
+        return access[0] | access[1], access[1]
+
+    def key(self, step, op, parset, H, inputs):
+        """
+        Return the key of the result of a step
+        """
+        h = hashlib.sha1()
+        h.update( '\n'.join([_version.__version__, op, parsetHash( step, parset )]) )
+        for ss_st in sorted(inputs):
+            h.update( '\n%s %s' % (ss_st, soltabHash( H.H.get_node('/'+ss_st) )) )
+        for solset in sorted(set([ss_st.split('/')[0] for ss_st in inputs])):
+            for table in ['antenna', 'source']:
+                if table in H.getSoltabs(solset):
+                    h.update( np.asarray(H.H.get_node('/'+solset+'/'+table).read()).tostring() )
+        h.update( '\n'.join(sorted(H.getSolsets().keys()) + sorted(self._soltabs(H))) )
+        return h.hexdigest()
+
+    def _fileName(self, key):
+        return os.path.join(self.cacheDir, key+'.h5')
+
+    def get(self, key, H):
+        """
+        Copy the result in the h5parm, return False if it is not in the cache
+        """
+        fileName = self._fileName(key)
+        if not os.path.isfile(fileName): return False
+        try:
+            f = tables.open_file(fileName, 'r')
+        except Exception, e:
+            logging.warning('Cannot read cache file %s: %s' % (fileName, e))
+            return False
+        try:
+            for group in f.root:
+                if group._v_attrs['new_solset']:
+                    clearSharing(group._f_copy(newparent=H.H.root, newname=group._v_name, recursive=True))
+                    continue
+                for soltab in group:
+                    if soltab._v_name in H.getSoltabs(group._v_name): H.delSoltab(group._v_name, soltab._v_name)
+                    clearSharing(soltab._f_copy(newparent=H.getSolset(group._v_name), newname=soltab._v_name, recursive=True))
+        finally:
+            f.close()
+        # least recently used results are removed first
+        os.utime(fileName, None)
+        return True
+
+    def put(self, key, H, newSolsets, outputs):
+        """
+        Store a result: the new solsets and the other soltabs written by the step
+        """
+        fileName = self._fileName(key)
+        tmpName = fileName + '.%i.tmp' % os.getpid()
+        f = tables.open_file(tmpName, 'w')
+        try:
+            for solset in newSolsets:
+                group = H.getSolset(solset)._f_copy(newparent=f.root, newname=solset, recursive=True)
+                clearSharing(group)
+                group._v_attrs['new_solset'] = True
+            for ss_st in outputs:
+                solset, soltab = ss_st.split('/')
+                if solset in newSolsets: continue
+                if not solset in f.root:
+                    f.create_group('/', solset)._v_attrs['new_solset'] = False
+                clearSharing(H.getSoltab(solset, soltab)._f_copy(newparent=f.get_node('/'+solset), newname=soltab, recursive=True))
+            f.root._v_attrs['outputs'] = json.dumps(sorted(outputs))
+        except:
+            f.close()
+            os.remove(tmpName)
+            raise
+        f.close()
+        os.rename(tmpName, fileName)
+        self._evict()
+
+    def _evict(self):
+        """
+        Remove the least recently used results until the cache fits in maxSize
+        """
+        files = []
+        for name in os.listdir(self.cacheDir):
+            if not name.endswith('.h5'): continue
+            try:
+                st = os.stat(os.path.join(self.cacheDir, name))
+                files.append((st.st_mtime, st.st_size, name))
+            except OSError: pass # removed by another process
+        size = sum([s for t, s, name in files])
+        for t, s, name in sorted(files):
+            if size <= self.maxSize*1024*1024: break
+            logging.debug('Removing %s from the cache.' % name)
+            try: os.remove(os.path.join(self.cacheDir, name))
+            except OSError: pass
+            size -= s
+
+    def run(self, step, op, parset, H, runFunct):
+        """
+        Run a step through the cache, runFunct( step, parset, H ) is the operation
+        """
+        # the hashes and the copies are made of the data on disk
+        if getWorkingSet() is not None: getWorkingSet().flush(H.H.filename)
+        inputs, writes = self._access( step, op, parset, H )
+        key = self.key( step, op, parset, H, inputs )
+        if self.get( key, H ):
+            logging.info('Result of step \'%s\' restored from the cache (%s).' % (step, key))
+            self.hits += 1
+            return 0
+
+        self.misses += 1
+        solsets = H.getSolsets().keys()
+        soltabs = self._soltabs( H )
+        returncode = runFunct( step, parset, H )
+        if returncode != 0: return returncode
+
+        if getWorkingSet() is not None: getWorkingSet().flush(H.H.filename)
+        newSolsets = [solset for solset in H.getSolsets().keys() if not solset in solsets]
+        outputs = [ss_st for ss_st in self._soltabs( H ) if not ss_st in soltabs or ss_st in writes]
+        try:
+            self.put( key, H, newSolsets, outputs )
+            logging.debug('Result of step \'%s\' stored in the cache (%s).' % (step, key))
+        except Exception, e:
+            logging.warning('Cannot store the result of step \'%s\' in the cache: %s' % (step, e))
+        return returncode
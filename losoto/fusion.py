@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Fuse consecutive simple steps on the same soltabs into a single pass over the data
+
+import logging
+from losoto.h5parm import solFetcher, solWriter, hdf5Lock
+from losoto.operations_lib import *
+from losoto.scheduler import stepAccess
+
+# operations providing a kernel( step, parset, H, soltab ) which returns:
+# * a function modifying in place the values and weights of a slice: funct(vals, weights, coord, selection)
+# * the axes which must be complete in a slice (None if any slice is fine)
+# * the entry for the soltab history
+# * a function called after all the slices are processed (or None)
+# * whether the function modifies the weights (if no kernel of a group does, they are not written back)
+# or None if the step cannot be fused (it is then run normally)
+# the kernels of a group are compiled before running it, so they must not depend on the data of the group soltabs
+fusableOps = ['ABS', 'NORM', 'RESET', 'RESIDUALS', 'REWEIGHT']
+# operations which work on the whole soltab, ignoring the selection
+fullTableOps = ['RESIDUALS']
+
+def stepSelection( step, op, parset, H, soltab ):
+    """
+    Return the selection used by a step on a soltab
+    """
+    userSel = {}
+    for axis in solFetcher(soltab).getAxesNames():
+        if op in fullTableOps: userSel[axis] = None
+        else: userSel[axis] = getParAxis( step, parset, H, axis )
+    return userSel
+
+
+def _compile( step, op, parset, H, soltabs, ops, returnAxes ):
+    """
+    Return the kernels of a step for each soltab and the axes required in the slices,
+    None if the step cannot be fused with steps requiring returnAxes
+    """
+    kernels = []
+    for soltab in openSoltabs( H, soltabs ):
+        kernel = ops[op].kernel( step, parset, H, soltab )
+        if kernel is None: return None
+        if kernel[1] is not None:
+            # e.g. two normalizations along different axes
+            if returnAxes is not None and sorted(kernel[1]) != sorted(returnAxes): return None
+            returnAxes = kernel[1]
+        kernels.append(kernel)
+    return kernels, returnAxes
+
+
+def fuseSteps( steps, parset, H, ops ):
+    """
+    Iterate over the groups of consecutive steps which can run in a single pass as (steps, kernels):
+    same fusable operation type, same soltabs and same selection and no step reading a soltab
+    modified by the group. The kernels are None for the steps which must run normally.
+    The next group is found only when the previous one has run.
+    """
+    i = 0
+    while i < len(steps):
+        group = [steps[i]]
+        kernels = None
+        op = parset.getString( '.'.join( [ "LoSoTo.Steps", steps[i], "Operation" ] ) )
+        if op in fusableOps and op in ops:
+            soltabs = getParSoltabs( steps[i], parset, H )
+            selections = [stepSelection( steps[i], op, parset, H, soltab ) for soltab in openSoltabs( H, soltabs )]
+            reads, writes = stepAccess( steps[i], op, parset, H )
+            compiled = None
+            if len((reads - writes) & set(soltabs)) == 0:
+                compiled = _compile( steps[i], op, parset, H, soltabs, ops, None )
+            if compiled is not None:
+                kernels, returnAxes = [[kernel] for kernel in compiled[0]], compiled[1]
+                for step in steps[i+1:]:
+                    op = parset.getString( '.'.join( [ "LoSoTo.Steps", step, "Operation" ] ) )
+                    if not op in fusableOps or not op in ops: break
+                    if getParSoltabs( step, parset, H ) != soltabs: break
+                    if [stepSelection( step, op, parset, H, soltab ) for soltab in openSoltabs( H, soltabs )] != selections: break
+                    reads, writes = stepAccess( step, op, parset, H )
+                    if len((reads - writes) & set(soltabs)) > 0: break
+                    compiled = _compile( step, op, parset, H, soltabs, ops, returnAxes )
+                    if compiled is None: break
+                    for soltabKernels, kernel in zip(kernels, compiled[0]): soltabKernels.append(kernel)
+                    returnAxes = compiled[1]
+                    group.append(step)
+                kernels = zip(openSoltabs( H, soltabs ), kernels, [returnAxes]*len(soltabs))
+        # a single step runs normally
+        if len(group) == 1: kernels = None
+        yield group, kernels
+        i += len(group)
+
+
+def runFused( steps, kernels, parset, H ):
+    """
+    Run a group of steps (see fuseSteps()) with a single read and write of each slice of data
+    """
+    op = parset.getString( '.'.join( [ "LoSoTo.Steps", steps[0], "Operation" ] ) )
+    memoryLimit = getParMemoryLimit( steps[0], parset )
+    prefetch = getParPrefetch( steps[0], parset )
+
+    for soltab, soltabKernels, returnAxes in kernels:
+
+        logging.info("Running fused steps (%s) on soltab: %s" % (', '.join(steps), soltab._v_name))
+
+        userSel = stepSelection( steps[0], op, parset, H, soltab )
+        sf = solFetcher(soltab)
+        sf.setSelection(**userSel)
+        # elementwise kernels: the whole selection, or slices along the first axis if the memory is limited
+        if returnAxes is None:
+            if memoryLimit is None: returnAxes = sf.getAxesNames()
+            else: returnAxes = sf.getAxesNames()[1:]
+
+        # with a memory limit the data are written directly on disk, otherwise only the selection is cached
+        sw = solWriter(soltab, useCache = memoryLimit is None, **userSel) # remember to flush!
+        writesWeights = any([kernel[4] for kernel in soltabKernels])
+
+        # the kernels access the data only through getValues(), so the prefetch thread can read while they run
+        with hdf5Lock.released():
+            for vals, weights, coord, selection in sf.getValuesIter(returnAxes=returnAxes, weight=True, memoryLimit=memoryLimit, prefetch=prefetch):
+                for funct, axes, history, finish, weightsOut in soltabKernels:
+                    funct(vals, weights, coord, selection)
+                sw.selection = selection
+                sw.setValues(vals)
+                if writesWeights: sw.setValues(weights, weight=True)
+
+        if sw.useCache: sw.flush()
+        for funct, axes, history, finish, weightsOut in soltabKernels:
+            if finish is not None: finish()
+            sw.addHistory(history)
+
+    return 0
@@ -9,22 +9,271 @@ import tables
 import logging
 import _version
 import itertools
+import weakref
+import collections
+import threading
+import Queue
+import time
+import ctypes, ctypes.util
+import zlib
 
 # check for tables version
 if int(tables.__version__.split('.')[0]) < 3:
     logging.critical('pyTables version must be >= 3.0.0, found: '+tables.__version__)
     sys.exit(1)
 
+class ioLock(object):
+    """
+    A reentrant lock which can be temporarily given up by the thread holding it while
+    it waits for something else (e.g. for the results of a pool of workers)
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._local = threading.local()
+
+    def acquire(self):
+        self._lock.acquire()
+        self._local.depth = getattr(self._local, 'depth', 0) + 1
+
+    def release(self):
+        self._local.depth -= 1
+        self._lock.release()
+
+    def held(self):
+        """
+        Return True if the lock is held by this thread
+        """
+        return getattr(self._local, 'depth', 0) > 0
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.release()
+
+    def released(self):
+        """
+        Context manager releasing the lock (if held by this thread) and acquiring it again at the end
+        """
+        lock = self
+        class releasedLock(object):
+            def __enter__(self):
+                self.depth = getattr(lock._local, 'depth', 0)
+                for i in xrange(self.depth): lock.release()
+            def __exit__(self, type, value, tb):
+                for i in xrange(self.depth): lock.acquire()
+        return releasedLock()
+
+# HDF5 is not thread safe, any thread reading or writing the data must hold this lock
+hdf5Lock = ioLock()
+
+def _locked(funct):
+    """
+    Decorator to run a method holding hdf5Lock
+    """
+    def lockedFunct(*args, **kwargs):
+        with hdf5Lock:
+            return funct(*args, **kwargs)
+    lockedFunct.__name__ = funct.__name__
+    lockedFunct.__doc__ = funct.__doc__
+    return lockedFunct
+
+
+class workingSet( object ):
+    """
+    Solution arrays (val and weight) kept in memory and shared by all the solHandlers, so that
+    consecutive operations on the same soltab read it from the file only once.
+    Modified arrays are written back only when flushed, when the least recently used arrays
+    are removed to make room for new ones or when the h5parm is closed.
+    """
+
+    def __init__(self, maxSize):
+        """
+        Keyword arguments:
+        maxSize -- maximum memory used (MB)
+        """
+        self.maxSize = int(maxSize*1024*1024)
+        self.size = 0
+        self.arrays = collections.OrderedDict() # (filename, path) -> [node, array, dirty], least recently used first
+        self.reads = 0
+        self.writes = 0
+
+    def _key(self, node):
+        return (node._v_file.filename, node._v_pathname)
+
+    def get(self, node, write=False):
+        """
+        Return the in-memory copy of an array (loaded if needed), None if it does not fit
+        Keyword arguments:
+        node -- the val or weight array of a soltab
+        write -- if true the array is going to be modified (default: False)
+        """
+        key = self._key(node)
+        with hdf5Lock:
+            if key in self.arrays:
+                entry = self.arrays.pop(key)
+            else:
+                size = int(np.prod(node.shape))*node.dtype.itemsize
+                if size > self.maxSize: return None
+                while self.size + size > self.maxSize: self._remove(self.arrays.keys()[0])
+                logging.debug('Loading %s into the working set.' % node._v_pathname)
+                entry = [node, node.read(), False]
+                self.size += size
+                self.reads += 1
+            entry[2] = entry[2] or write
+            self.arrays[key] = entry
+            return entry[1]
+
+    def _writeBack(self, key):
+        node, array, dirty = self.arrays[key]
+        if not dirty: return
+        logging.debug('Writing back %s from the working set.' % node._v_pathname)
+        node = _unshare(node)
+        self.arrays[key][0] = node
+        node[...] = array
+        updateChecksums(node, [slice(None)]*array.ndim, array)
+        self.arrays[key][2] = False
+        self.writes += 1
+
+    def _remove(self, key, writeBack=True):
+        if writeBack: self._writeBack(key)
+        node, array, dirty = self.arrays.pop(key)
+        self.size -= array.nbytes
+
+    def flush(self, filename=None):
+        """
+        Write back the modified arrays
+        Keyword arguments:
+        filename -- write back only the arrays of this file (default: all)
+        """
+        with hdf5Lock:
+            for key in self.arrays.keys():
+                if filename is None or key[0] == filename: self._writeBack(key)
+
+    def drop(self, filename, path='/', writeBack=True):
+        """
+        Forget the arrays of a file (or of a group of it)
+        Keyword arguments:
+        filename -- the file name
+        path -- forget only the arrays under this group (default: all)
+        writeBack -- if true the modified arrays are written back before (default: True)
+        """
+        with hdf5Lock:
+            for key in self.arrays.keys():
+                if key[0] == filename and (key[1]+'/').startswith(path.rstrip('/')+'/'):
+                    self._remove(key, writeBack)
+
+
+# the working set used by all the h5parms (see startWorkingSet())
+_workingSet = None
+
+def startWorkingSet(maxSize):
+    """
+    Keep the solution arrays in memory (up to maxSize MB) until they are flushed or the h5parm is closed
+    """
+    global _workingSet
+    if _workingSet is not None: stopWorkingSet()
+    _workingSet = workingSet(maxSize)
+    return _workingSet
+
+def getWorkingSet():
+    """
+    Return the working set, None if not started
+    """
+    return _workingSet
+
+def stopWorkingSet():
+    """
+    Write back the modified arrays and stop keeping them in memory
+    """
+    global _workingSet
+    if _workingSet is not None:
+        _workingSet.flush()
+        logging.debug('Working set: %i arrays read, %i written back.' % (_workingSet.reads, _workingSet.writes))
+        for key in _workingSet.arrays.keys(): _workingSet._remove(key, writeBack=False)
+        _workingSet = None
+
+def computeChunkShape(axesNames, shape, itemsize=8, returnAxes=['time','freq'], maxChunkSize=256*1024):
+    """
+    Return a chunk shape which spans the returnAxes (in the given order of priority)
+    and has length 1 on all the other axes, so that the data relative to a single
+    combination of the other axes (e.g. one antenna) are read from a small number of chunks.
+    Keyword arguments:
+    axesNames -- list with the axes names
+    shape -- list with the axes lengths
+    itemsize -- size in bytes of an element
+    returnAxes -- axes along which the data are usually accessed (default: time, freq),
+                  if none is present the fastest varying axes are used
+    maxChunkSize -- maximum size of a chunk in bytes
+    """
+    returnAxes = [axisName for axisName in returnAxes if axisName in axesNames]
+    if returnAxes == []: returnAxes = axesNames[::-1]
+
+    chunkShape = [1]*len(shape)
+    maxElements = max(1, maxChunkSize/itemsize)
+    for axisName in returnAxes:
+        idx = axesNames.index(axisName)
+        chunkShape[idx] = max(1, min(shape[idx], maxElements))
+        maxElements /= chunkShape[idx]
+        if maxElements <= 1: break
+
+    return chunkShape
+
+
+def computeBlockShape(shape, chunkShape, itemsize=8, maxBlockSize=512*1024*1024):
+    """
+    Return the shape of a block made of whole chunks which is as large as
+    possible without exceeding maxBlockSize. Blocks are grown along the
+    fastest varying axes first.
+    Keyword arguments:
+    shape -- list with the axes lengths
+    chunkShape -- list with the chunk shape (None for contiguous arrays)
+    itemsize -- size in bytes of an element
+    maxBlockSize -- maximum size of a block in bytes
+    """
+    if chunkShape is None: chunkShape = [1]*len(shape)
+    blockShape = [max(1, min(c, d)) for c, d in zip(chunkShape, shape)]
+    maxElements = max(1, maxBlockSize/itemsize)
+    for idx in reversed(xrange(len(shape))):
+        others = int(np.prod(blockShape))/blockShape[idx]
+        nChunks = max(1, (maxElements/others)/blockShape[idx])
+        blockShape[idx] = max(1, min(shape[idx], blockShape[idx]*nChunks))
+        if blockShape[idx] < shape[idx]: break
+
+    return blockShape
+
+
+def iterBlocks(shape, blockShape):
+    """
+    Return an iterator over the tuples of slices which cover an array of
+    the given shape with blocks of the given shape (in C order)
+    Keyword arguments:
+    shape -- list with the axes lengths
+    blockShape -- list with the block shape
+    """
+    nBlocks = [int(np.ceil(float(d)/b)) for d, b in zip(shape, blockShape)]
+    for blockIdx in np.ndindex(*nBlocks):
+        yield tuple([slice(i*b, min((i+1)*b, d)) for i, b, d in zip(blockIdx, blockShape, shape)])
+
+
 class h5parm( object ):
 
-    def __init__(self, h5parmFile, readonly=True, complevel=5, complib='zlib'):
+    def __init__(self, h5parmFile, readonly=True, complevel=5, complib='zlib', checksums=False):
         """
         Keyword arguments:
         h5parmFile -- H5parm filename
         readonly -- if True the table is open in readonly mode (default=True)
-        complevel -- compression level from 0 to 9 (default=5) when creating the file
-        complib -- library for compression: lzo, zlib, bzip2 (default=zlib)
+        complevel -- compression level from 0 to 9 (default=5) for new solution-tables,
+                     with 0 they are stored as contiguous uncompressed arrays
+        complib -- library for compression: lzo, zlib, bzip2, blosc (default=zlib)
+        checksums -- if True new solution-tables get the checksums of their blocks, see computeChecksums() (default=False)
         """
+        # used by makeSoltab() also when appending to an existing file
+        self.filters = tables.Filters(complevel=complevel, complib=complib)
+        self.checksums = checksums
+
         if os.path.isfile(h5parmFile):
             if not tables.is_hdf5_file(h5parmFile):
                 logging.critical('Not a HDF5 file: '+h5parmFile+'.')
@@ -50,8 +299,7 @@ class h5parm( object ):
             else:
                 logging.debug('Creating '+h5parmFile+'.')
                 # add a compression filter
-                f = tables.Filters(complevel=complevel, complib=complib)
-                self.H = tables.open_file(h5parmFile, filters=f, mode='w', IO_BUFFER_SIZE=1024*1024*10, BUFFER_TIMES=500)
+                self.H = tables.open_file(h5parmFile, filters=self.filters, mode='w', IO_BUFFER_SIZE=1024*1024*10, BUFFER_TIMES=500)
 
         self.fileName = h5parmFile
 
@@ -61,6 +309,7 @@ class h5parm( object ):
         Close the open table
         """
         logging.debug('Closing table.')
+        if _workingSet is not None: _workingSet.drop(self.H.filename)
         self.H.close()
 
 
@@ -149,7 +398,7 @@ class h5parm( object ):
 
     def makeSoltab(self, solset=None, soltype=None, soltab=None,
             axesNames = [], axesVals = [], chunkShape=None, vals=None,
-            weights=None, parmdbType=None):
+            weights=None, parmdbType=None, valDtype=np.float64, checksums=None):
         """
         Create a solution-table into a specified solution-set
         Keyword arguments:
@@ -158,10 +407,12 @@ class h5parm( object ):
         soltab -- the solution-table name (String) if not specified is generated from the solution-type
         axesNames -- list with the axes names
         axesVals -- list with the axes values
-        chunkShape -- list with the chunk shape
-        vals --
+        chunkShape -- list with the chunk shape (default: computed by computeChunkShape())
+        vals -- if None (together with weights) val/weight are only allocated and must be filled later
         weights -- 0->FLAGGED, 1->MAX_WEIGHT
         parmdbType -- original parmdb solution type
+        valDtype -- data type of the values (default: float64)
+        checksums -- if True add the checksums of the blocks of val and weight (default: as set for the h5parm)
         """
 
         if soltype is None:
@@ -198,37 +449,40 @@ class h5parm( object ):
         assert len(axesNames) == len(axesVals)
         dim = []
 
-#        newChunkShape = []
         for i, axisName in enumerate(axesNames):
-            #axis = self.H.create_carray('/'+solsetName+'/'+soltabName, axisName,\
-            #        obj=axesVals[i], chunkshape=[len(axesVals[i])])
             axis = self.H.create_array('/'+solsetName+'/'+soltabName, axisName, obj=axesVals[i])
             dim.append(len(axesVals[i]))
 
-#            # Put time/freq on max lenght for better performances
-#            if chunkShape == None:
-#                if axisName == 'time':
-#                    newChunkShape.append(100)
-#                elif axisName == 'freq':
-#                    newChunkShape.append(10)
-#                else:
-#                    newChunkShape.append(1)
-#        if chunkShape == None: chunkShape = newChunkShape
-#        logging.debug('Chunk shape: '+str(chunkShape))
-
         # check if the axes were in the proper order
-        assert dim == list(vals.shape)
-        assert dim == list(weights.shape)
-
-        # create the val/weight Carrays
-        #val = self.H.create_carray('/'+solsetName+'/'+soltabName, 'val', obj=vals.astype(np.float64), chunkshape=None, atom=tables.Float64Atom())
-        #weight = self.H.create_carray('/'+solsetName+'/'+soltabName, 'weight', obj=weights.astype(np.float16), chunkshape=None, atom=tables.Float16Atom())
-        # array do not have compression but are much faster
-        val = self.H.create_array('/'+solsetName+'/'+soltabName, 'val', obj=vals.astype(np.float64), atom=tables.Float64Atom())
-        weight = self.H.create_array('/'+solsetName+'/'+soltabName, 'weight', obj=weights.astype(np.float16), atom=tables.Float16Atom())
+        if vals is not None: assert dim == list(vals.shape)
+        if weights is not None: assert dim == list(weights.shape)
+
+        valAtom = tables.Atom.from_dtype(np.dtype(valDtype))
+        if chunkShape is None and self.filters.complevel == 0 and vals is not None and weights is not None:
+            # array do not have compression but are much faster
+            logging.debug('Contiguous storage (no compression).')
+            val = self.H.create_array('/'+solsetName+'/'+soltabName, 'val', obj=vals.astype(valDtype), atom=valAtom)
+            weight = self.H.create_array('/'+solsetName+'/'+soltabName, 'weight', obj=weights.astype(np.float16), atom=tables.Float16Atom())
+        else:
+            # chunked and compressed, by default chunks are time/freq-major
+            if chunkShape is None: chunkShape = computeChunkShape(axesNames, dim, itemsize=valAtom.itemsize)
+            chunkShape = [max(1, min(c, d)) for c, d in zip(chunkShape, dim)]
+            logging.debug('Chunk shape: '+str(chunkShape)+' - '+str(self.filters))
+            if vals is not None: vals = vals.astype(valDtype)
+            if weights is not None: weights = weights.astype(np.float16)
+            val = self.H.create_carray('/'+solsetName+'/'+soltabName, 'val', obj=vals, atom=valAtom, shape=tuple(dim), \
+                    chunkshape=chunkShape, filters=self.filters)
+            weight = self.H.create_carray('/'+solsetName+'/'+soltabName, 'weight', obj=weights, atom=tables.Float16Atom(), shape=tuple(dim), \
+                    chunkshape=chunkShape, filters=self.filters)
         val.attrs['AXES'] = ','.join([axisName for axisName in axesNames])
         weight.attrs['AXES'] = ','.join([axisName for axisName in axesNames])
 
+        # checksums of the blocks, kept updated by the solWriters (arrays not filled here are zeros)
+        if checksums is None: checksums = self.checksums
+        if checksums:
+            computeChecksums(val, vals if vals is not None else 0.)
+            computeChecksums(weight, weights if weights is not None else 0.)
+
         return soltab
 
 
@@ -244,9 +498,57 @@ class h5parm( object ):
 
         if type(soltab) is str:
             soltabobj = self.getSoltab(solset, soltab)
+        else:
+            soltabobj = soltab
 
+        if _workingSet is not None: _workingSet.drop(self.H.filename, soltabobj._v_pathname, writeBack=False)
+        # arrays shared with lazy snapshots are kept for the other soltabs
+        for leaf in soltabobj._f_list_nodes('Leaf'): _unlink(leaf)
+        soltabName = soltabobj._v_name
         soltabobj._f_remove(recursive=True)
-        logging.info("Soltab \""+soltab+"\" deleted.")
+        logging.info("Soltab \""+soltabName+"\" deleted.")
+
+
+    def snapshotSoltab(self, solset=None, soltab=None, outSolset=None, outSoltab=None, lazy=False):
+        """
+        Copy a solution-table and return the copy. HDF5 copies the arrays chunk by chunk,
+        the table is never loaded in memory.
+        Keyword arguments:
+        solset -- a solution-set name (String) or a Group instance (required if soltab is a string)
+        soltab -- a solution-table name (String) or instance
+        outSolset -- the solution-set of the copy, name or Group instance (default: the same of the table)
+        outSoltab -- the name of the copy (default: generated from the solution-type)
+        lazy -- if True the arrays are shared by the table and the copy and an array is copied only
+                before one of them writes it, so the arrays which are never written are never copied (default: False)
+        """
+        if type(soltab) is str: soltab = self.getSoltab(solset, soltab)
+        if outSolset is None: outSolset = soltab._v_parent
+        elif type(outSolset) is str: outSolset = self.getSolset(outSolset)
+
+        if outSoltab in outSolset._v_groups:
+            logging.warning('Solution-table '+outSoltab+' already present. Switching to default.')
+            outSoltab = None
+        if outSoltab is None:
+            outSoltab = self._fisrtAvailSoltabName(outSolset, soltab._v_title)
+
+        # the copy is made of the data on disk
+        if _workingSet is not None: _workingSet.drop(self.H.filename, soltab._v_pathname)
+
+        if not lazy:
+            logging.info('Copying solution-table '+soltab._v_pathname+' into '+outSolset._v_pathname+'/'+outSoltab+'.')
+            copy = soltab._f_copy(newparent=outSolset, newname=outSoltab, recursive=True)
+            clearSharing(copy)
+            return copy
+
+        logging.info('Creating a snapshot of solution-table '+soltab._v_pathname+' into '+outSolset._v_pathname+'/'+outSoltab+'.')
+        copy = self.H.create_group(outSolset, outSoltab, title=soltab._v_title)
+        soltab._v_attrs._f_copy(copy)
+        for leaf in soltab._f_list_nodes('Leaf'):
+            # the number of soltabs sharing the array, the attributes are shared too
+            attrs = _sharedAttrs(leaf)
+            attrs['COW_LINKS'] = attrs['COW_LINKS'] + 1 if 'COW_LINKS' in attrs else 2
+            self.H.create_hard_link(copy, str(leaf._v_name), leaf)
+        return copy
 
 
     def getSoltabs(self, solset=None):
@@ -474,6 +776,471 @@ class h5parm( object ):
         return info
 
 
+def _planAxis(sel, chunkLen=None):
+    """
+    Convert the selection of one axis into a list of (source, take, destination) groups:
+    source is what is read from the table (a slice or an int), take are the positions
+    to keep inside the source slice (None to keep all) and destination is the slice
+    of the output (None if the axis is dropped).
+    Lists are split in runs of contiguous indexes, runs falling in the same chunk are merged
+    since the whole chunk is read anyway.
+    Keyword arguments:
+    sel -- selection of this axis (slice, int or list)
+    chunkLen -- length of the chunks along this axis (None for contiguous arrays)
+    """
+    if type(sel) is not list:
+        if isinstance(sel, (int, long, np.integer)): return [(sel, None, None)]
+        return [(sel, None, slice(None))]
+
+    groups = []
+    start = 0 # position in the output of the first element of the current group
+    for i in xrange(1, len(sel)+1):
+        if i < len(sel):
+            if sel[i] == sel[i-1]+1: continue
+            if chunkLen is not None and sel[i] > sel[i-1] and sel[i]/chunkLen == sel[start]/chunkLen: continue
+        idx = np.array(sel[start:i])
+        if idx[-1]-idx[0]+1 == len(idx): take = None
+        else: take = idx-idx[0]
+        groups.append((slice(idx[0], idx[-1]+1), take, slice(start, i)))
+        start = i
+
+    return groups
+
+
+def _planSelection(selection, chunkShape=None, maxReads=256):
+    """
+    Return the per-axis list of groups (see _planAxis()) to read/write a selection
+    made of slices and (possibly many) lists. If the number of hyperslabs is larger than
+    maxReads, the axes with more groups are collapsed into a single bounding slice.
+    Keyword arguments:
+    selection -- list of slices/ints/lists
+    chunkShape -- chunk shape of the table (None for contiguous arrays)
+    maxReads -- maximum number of hyperslabs
+    """
+    if chunkShape is None: chunkShape = [None]*len(selection)
+    plan = [_planAxis(sel, chunkLen) for sel, chunkLen in zip(selection, chunkShape)]
+
+    while np.prod([len(groups) for groups in plan]) > maxReads:
+        idx = np.argmax([len(groups) for groups in plan])
+        sel = np.array(selection[idx])
+        plan[idx] = [(slice(sel.min(), sel.max()+1), sel-sel.min(), slice(None))]
+
+    return plan
+
+
+def _sharedAttrs(node):
+    """
+    Return the attributes of an array shared with lazy snapshots, read again from the file:
+    the hard links share them but PyTables keeps a separate (possibly outdated) list for each node
+    """
+    return tables.attributeset.AttributeSet(node)
+
+
+def _unlink(node):
+    """
+    Remove an array from its soltab, updating the count of the soltabs sharing it (see h5parm.snapshotSoltab())
+    """
+    attrs = _sharedAttrs(node)
+    if 'COW_LINKS' in attrs:
+        links = attrs['COW_LINKS'] - 1
+        if links <= 1: del attrs['COW_LINKS']
+        else: attrs['COW_LINKS'] = links
+    node._f_remove()
+
+
+def clearSharing(node):
+    """
+    Remove the count of the soltabs sharing the arrays (see h5parm.snapshotSoltab()) from a plain copy
+    (e.g. made with _f_copy()) of a shared array, or of the arrays of a soltab/solset: the copy is not shared
+    Keyword arguments:
+    node -- the copy, a Leaf or a Group
+    """
+    if isinstance(node, tables.Leaf): leaves = [node]
+    else: leaves = node._f_walknodes('Leaf')
+    for leaf in leaves:
+        # the attributes are copied from the list of the node, which may be outdated
+        if 'COW_LINKS' in leaf._v_attrs: del leaf._v_attrs['COW_LINKS']
+
+
+def _unshare(node):
+    """
+    Give a private copy of an array shared with a lazy snapshot to its soltab, return the array to write
+    """
+    if not 'COW_LINKS' in _sharedAttrs(node): return node
+    parent, name = node._v_parent, node._v_name
+    logging.debug('Copying the shared array %s before writing it.' % node._v_pathname)
+    copy = node._f_copy(newparent=parent, newname=name+'_cow_tmp')
+    clearSharing(copy)
+    _unlink(node)
+    copy._f_rename(name)
+    return copy
+
+
+def _checksumBlockShape(node):
+    """
+    Return the shape of the blocks with a checksum: the chunks, or the chunks that
+    computeChunkShape() would give for contiguous arrays
+    """
+    if node.chunkshape is not None: return list(node.chunkshape)
+    return computeChunkShape(node.attrs['AXES'].split(','), node.shape, itemsize=node.dtype.itemsize)
+
+
+def _blockChecksum(data, dtype):
+    return zlib.crc32(np.ascontiguousarray(data, dtype=dtype)) & 0xffffffff
+
+
+def getChecksums(node):
+    """
+    Return the array with the checksums of the blocks of a val or weight array, None if missing
+    """
+    name = node._v_name+'_crc'
+    if name in node._v_parent._v_children: return node._v_parent._f_get_child(name)
+    return None
+
+
+def computeChecksums(node, data=None, maxBlockSize=64*1024*1024):
+    """
+    Create (or replace) the crc32 checksums of the blocks of a val or weight array,
+    stored in the array "val_crc" or "weight_crc" of the soltab (one element per block)
+    Keyword arguments:
+    node -- the val or weight array
+    data -- the content of the array if already in memory, or a scalar if the array is filled with
+            it (default: None, the array is read in pieces of maxBlockSize bytes)
+    """
+    shape = list(node.shape)
+    blockShape = _checksumBlockShape(node)
+    nBlocks = [int(np.ceil(float(d)/b)) for d, b in zip(shape, blockShape)]
+    checksums = np.zeros(nBlocks, dtype=np.uint32)
+
+    if data is not None and np.isscalar(data):
+        # only the blocks on the borders have a different shape
+        known = {}
+        for block in iterBlocks(shape, blockShape):
+            blockIdx = tuple([s.start/b for s, b in zip(block, blockShape)])
+            blockLen = tuple([s.stop-s.start for s in block])
+            if not blockLen in known: known[blockLen] = _blockChecksum(np.full(blockLen, data), node.dtype)
+            checksums[blockIdx] = known[blockLen]
+    else:
+        readShape = computeBlockShape(shape, blockShape, itemsize=node.dtype.itemsize, maxBlockSize=maxBlockSize)
+        for piece in iterBlocks(shape, readShape):
+            pieceData = node[piece] if data is None else data[piece]
+            for block in iterBlocks(pieceData.shape, blockShape):
+                blockIdx = tuple([(p.start+s.start)/b for p, s, b in zip(piece, block, blockShape)])
+                checksums[blockIdx] = _blockChecksum(pieceData[block], node.dtype)
+
+    oldChecksums = getChecksums(node)
+    if oldChecksums is not None: _unlink(oldChecksums)
+    crc = node._v_file.create_array(node._v_parent, node._v_name+'_crc', obj=checksums)
+    crc.attrs['BLOCKSHAPE'] = blockShape
+    return crc
+
+
+def updateChecksums(node, selection, vals=None):
+    """
+    Update the checksums of the blocks of a val or weight array touched by a write (if the array has checksums).
+    The blocks entirely written are computed from vals (if given), the others are read back.
+    Keyword arguments:
+    node -- the val or weight array
+    selection -- list of slices/ints/lists, the selection written
+    vals -- the values written, with the shape of the selection (default: None)
+    """
+    crc = getChecksums(node)
+    if crc is None: return
+    crc = _unshare(crc)
+    shape = list(node.shape)
+    blockShape = list(crc.attrs['BLOCKSHAPE'])
+
+    touched = []
+    for sel, axisLen, b in zip(selection, shape, blockShape):
+        pos = np.atleast_1d(np.arange(axisLen)[sel])
+        touched.append(np.unique(pos/b))
+    # blocks can be taken from vals only if the selection is made of slices with unit step
+    fromVals = vals is not None and not np.isscalar(vals) and \
+            all([type(sel) is slice and sel.step in [None, 1] for sel in selection])
+    if fromVals:
+        ranges = [sel.indices(axisLen)[:2] for sel, axisLen in zip(selection, shape)]
+        vals = np.reshape(vals, [stop-start for start, stop in ranges])
+
+    checksums = crc.read()
+    for blockIdx in itertools.product(*touched):
+        block = tuple([slice(i*b, min((i+1)*b, d)) for i, b, d in zip(blockIdx, blockShape, shape)])
+        if fromVals and all([start <= s.start and s.stop <= stop for s, (start, stop) in zip(block, ranges)]):
+            data = vals[tuple([slice(s.start-start, s.stop-start) for s, (start, stop) in zip(block, ranges)])]
+        else:
+            data = node[block]
+        checksums[blockIdx] = _blockChecksum(data, node.dtype)
+    crc[...] = checksums
+
+
+def verifyChecksums(node, blocks=None):
+    """
+    Return the list of the indexes of the blocks whose content does not match the checksums,
+    None if the array has no checksums
+    Keyword arguments:
+    node -- the val or weight array
+    blocks -- list of block indexes to check (default: all)
+    """
+    crc = getChecksums(node)
+    if crc is None: return None
+    shape = list(node.shape)
+    blockShape = list(crc.attrs['BLOCKSHAPE'])
+    checksums = crc.read()
+    if blocks is None: blocks = np.ndindex(*checksums.shape)
+    bad = []
+    for blockIdx in blocks:
+        blockIdx = tuple(blockIdx)
+        block = tuple([slice(i*b, min((i+1)*b, d)) for i, b, d in zip(blockIdx, blockShape, shape)])
+        if _blockChecksum(node[block], node.dtype) != checksums[blockIdx]: bad.append(blockIdx)
+    return bad
+
+
+def _selectionShape(selection, shape):
+    """
+    Return the shape of the array selected by selection (axes selected with an int are dropped)
+    Keyword arguments:
+    selection -- list of slices/ints/lists
+    shape -- shape of the table
+    """
+    selShape = []
+    for sel, axisLen in zip(selection, shape):
+        if type(sel) is list: selShape.append(len(sel))
+        elif type(sel) is slice: selShape.append(len(xrange(*sel.indices(axisLen))))
+    return selShape
+
+
+# libhdf5 (the one loaded by pytables) used to find the position of the datasets in the file
+_hdf5Lib = None
+# memory maps of the contiguous datasets: node -> (offset, dtype, shape) or None if not mappable
+_memmapInfo = weakref.WeakKeyDictionary()
+
+def _getHDF5Lib():
+    """
+    Return the libhdf5 used by pytables through ctypes, None if it cannot be found
+    """
+    global _hdf5Lib
+    if _hdf5Lib is not None: return _hdf5Lib or None
+
+    _hdf5Lib = False
+    paths = []
+    # the library already loaded in this process (pytables wheels have their own copy)
+    if os.path.exists('/proc/self/maps'):
+        for line in open('/proc/self/maps'):
+            path = line.split()[-1]
+            if 'libhdf5' in os.path.basename(path) and not 'libhdf5_hl' in path and not path in paths:
+                paths.append(path)
+    if ctypes.util.find_library('hdf5') is not None:
+        paths.append(ctypes.util.find_library('hdf5'))
+
+    for path in paths:
+        try:
+            lib = ctypes.CDLL(path)
+            lib.H5Dget_offset.restype = ctypes.c_uint64
+            # hid_t is 64 bits from HDF5 1.10
+            if [int(v) for v in tables.hdf5_version.split('.')[:2]] >= [1, 10]: lib.H5Dget_offset.argtypes = [ctypes.c_int64]
+            else: lib.H5Dget_offset.argtypes = [ctypes.c_int]
+            _hdf5Lib = lib
+            break
+        except (OSError, AttributeError):
+            continue
+    if not _hdf5Lib: logging.debug('Cannot find libhdf5, memory maps disabled.')
+    return _hdf5Lib or None
+
+
+def _memmap(dataVals):
+    """
+    Return a copy-on-write memory map of a contiguous, unfiltered dataset,
+    None if the dataset cannot be mapped.
+    The pages not modified through the map show the later writes to the file.
+    Keyword arguments:
+    dataVals -- a pytables Array
+    """
+    if type(dataVals) is not tables.Array: return None
+
+    with hdf5Lock:
+        # the map reads the file, so nothing must be left in the HDF5 buffers
+        if dataVals._v_file.mode != 'r': dataVals.flush()
+
+        if not dataVals in _memmapInfo:
+            _memmapInfo[dataVals] = None
+            # only plain contiguous arrays on a normal file
+            if dataVals.filters.complevel != 0 or dataVals._v_file.params.get('DRIVER') not in [None, 'H5FD_SEC2'] \
+                    or dataVals.nrows == 0:
+                return None
+            lib = _getHDF5Lib()
+            if lib is None: return None
+            offset = lib.H5Dget_offset(dataVals._v_objectid)
+            if offset == 2**64-1: return None # HADDR_UNDEF: storage not allocated
+            if dataVals.byteorder == 'big': dtype = dataVals.atom.dtype.newbyteorder('>')
+            else: dtype = dataVals.atom.dtype.newbyteorder('<')
+            # check the mapping against pytables (e.g. files with a user block)
+            mm = np.memmap(dataVals._v_file.filename, dtype=dtype, mode='c', offset=offset, shape=dataVals.shape)
+            for idx in [tuple([0]*dataVals.ndim), tuple([d-1 for d in dataVals.shape])]:
+                if mm[idx].tobytes() != np.asarray(dataVals[idx], dtype=dtype).tobytes():
+                    logging.debug('Memory map of '+dataVals._v_pathname+' does not match the data, disabled.')
+                    return None
+            logging.debug('Reading '+dataVals._v_pathname+' through a memory map.')
+            _memmapInfo[dataVals] = (offset, dtype, dataVals.shape)
+
+    if _memmapInfo[dataVals] is None: return None
+    offset, dtype, shape = _memmapInfo[dataVals]
+    # a new copy-on-write map for each read, so changes to returned arrays never leak to other reads
+    return np.memmap(dataVals._v_file.filename, dtype=dtype, mode='c', offset=offset, shape=shape)
+
+
+def _readSelection(dataVals, selection):
+    """
+    Return the data of dataVals (a table or an ndarray) selected by selection.
+    Pytables allows only one list per read, multiple lists are read with the
+    minimal number of hyperslabs and assembled into a preallocated array.
+    Keyword arguments:
+    dataVals -- pytables array or ndarray
+    selection -- list of slices/ints/lists
+    """
+    listAxes = [i for i, sel in enumerate(selection) if type(sel) is list]
+
+    # ndarrays: slices first (a view), then lists one axis at a time
+    if isinstance(dataVals, np.ndarray):
+        basicSelection = [slice(None) if type(sel) is list else sel for sel in selection]
+        data = dataVals[tuple(basicSelection)]
+        for i in listAxes:
+            # axes dropped by an int selection shift the position of the others
+            axis = i - len([sel for sel in selection[:i] if isinstance(sel, (int, long, np.integer))])
+            data = np.take(data, selection[i], axis=axis)
+        return data
+
+    if len(listAxes) <= 1:
+        return dataVals[tuple(selection)]
+
+    logging.debug('Optimizing selection reading '+str(selection))
+    plan = _planSelection(selection, getattr(dataVals, 'chunkshape', None))
+
+    data = np.empty(_selectionShape(selection, dataVals.shape), dtype=dataVals.dtype)
+
+    for groups in itertools.product(*plan):
+        block = dataVals[tuple([group[0] for group in groups])]
+        groups = [group for group in groups if group[2] is not None]
+        for axis, group in enumerate(groups):
+            if group[1] is not None: block = np.take(block, group[1], axis=axis)
+        data[tuple([group[2] for group in groups])] = block
+
+    return data
+
+
+def _writeSelection(dataVals, selection, vals):
+    """
+    Write vals into the part of dataVals (a table or an ndarray) selected by selection.
+    Multiple lists are written with one write per run of contiguous indexes, runs which
+    share a chunk are merged and written with a single read-modify-write of the chunk.
+    Keyword arguments:
+    dataVals -- pytables array or ndarray
+    selection -- list of slices/ints/lists
+    vals -- an array with the size of the selection or a single value
+    """
+    listAxes = [i for i, sel in enumerate(selection) if type(sel) is list]
+    shape = _selectionShape(selection, dataVals.shape)
+    # the reshape is needed when saving e.g. [512] (vals shape) into [512,1,1] (selection output)
+    if not np.isscalar(vals): vals = np.reshape(vals, shape)
+
+    # ndarrays: outer indexing on all the axes (numpy would move the list axis if mixed with ints)
+    if isinstance(dataVals, np.ndarray) and len(listAxes) > 0:
+        index = []
+        for sel, axisLen in zip(selection, dataVals.shape):
+            if type(sel) is list: index.append(sel)
+            elif type(sel) is slice: index.append(range(*sel.indices(axisLen)))
+            else: index.append([sel])
+        dataVals[np.ix_(*index)] = np.reshape(vals, [len(i) for i in index]) if not np.isscalar(vals) else vals
+        return
+
+    if len(listAxes) <= 1:
+        dataVals[tuple(selection)] = vals
+        return
+
+    logging.debug('Optimizing selection writing '+str(selection))
+    plan = _planSelection(selection, getattr(dataVals, 'chunkshape', None))
+
+    for groups in itertools.product(*plan):
+        source = tuple([group[0] for group in groups])
+        groups = [group for group in groups if group[2] is not None]
+        if np.isscalar(vals): block = vals
+        else: block = vals[tuple([group[2] for group in groups])]
+
+        if all([group[1] is None for group in groups]):
+            dataVals[source] = block
+        else:
+            # read-modify-write of the hyperslab
+            data = dataVals[source]
+            index = [group[1] if group[1] is not None else range(data.shape[axis]) for axis, group in enumerate(groups)]
+            data[np.ix_(*index)] = block
+            dataVals[source] = data
+
+
+class axisIndex( object ):
+    """
+    Index of the values of an axis: a value -> position dict for string axes
+    and a sorted copy of the values for numeric axes.
+    It is shared by all the solHandlers of a soltab through axisIndex.get().
+    """
+    # axis node -> axisIndex
+    _indexes = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def get(cls, axis):
+        """
+        Return the index of an axis (pytables array), building it if needed
+        """
+        try:
+            return cls._indexes[axis]
+        except KeyError:
+            cls._indexes[axis] = cls(axis)
+            return cls._indexes[axis]
+
+    @classmethod
+    def reset(cls, axis):
+        """
+        Drop the index of an axis (e.g. after its values are modified)
+        """
+        cls._indexes.pop(axis, None)
+
+    def __init__(self, axis):
+        self.vals = np.asarray(axis[:])
+        if self.vals.dtype.char == 'S':
+            # in reversed order to keep the first position of duplicates
+            self.pos = dict((v, i) for i, v in reversed(list(enumerate(self.vals))))
+        self.order = np.argsort(self.vals, kind='mergesort')
+        self.sortedVals = self.vals[self.order]
+        # time and freq are always sorted, then ranges are simple slices
+        self.isSorted = bool(np.all(self.order == np.arange(len(self.order))))
+
+    def find(self, vals):
+        """
+        Return the (ordered) list of positions of the values present on the axis
+        Keyword arguments:
+        vals -- array of values to look for
+        """
+        if self.vals.dtype.char == 'S':
+            return sorted([self.pos[v] for v in set(vals) if v in self.pos])
+
+        vals = np.asarray(vals)
+        idx = np.searchsorted(self.sortedVals, vals)
+        found = idx < len(self.sortedVals)
+        found[found] = self.sortedVals[idx[found]] == vals[found]
+        return sorted(set(self.order[idx[found]].tolist()))
+
+    def findRange(self, vmin=None, vmax=None, tol=0.):
+        """
+        Return the positions of the values between vmin and vmax (included) with a binary search,
+        as a slice if the axis is sorted or as an ordered list otherwise
+        Keyword arguments:
+        vmin -- minimum value (None for no limit)
+        vmax -- maximum value (None for no limit)
+        tol -- tolerance added to the limits
+        """
+        start = 0 if vmin is None else np.searchsorted(self.sortedVals, vmin-tol, side='left')
+        stop = len(self.sortedVals) if vmax is None else np.searchsorted(self.sortedVals, vmax+tol, side='right')
+        if self.isSorted: return slice(int(start), int(max(start, stop)))
+        return sorted(self.order[start:stop].tolist())
+
+
 class solHandler( object ):
     """
     Generic #class to principally handle selections
@@ -485,12 +1252,14 @@ class solHandler( object ):
     axisName = {min: xxx} # to selct values grater or equal than xxx
     axisName = {max: yyy} # to selct values lower or equal than yyy
     axisName = {min: xxx, max: yyy} # to selct values greater or equal than xxx and lower or equal than yyy
+    axisName = {min: xxx, max: yyy, tol: zzz} # as above but with limits extended by a tolerance zzz
+    axisName = [{min: xxx, max: yyy}, {min: www}] # to select multiple ranges
     """
     def __init__(self, table, useCache = False, **args):
         """
         Keyword arguments:
         table -- table object or solset/soltab string
-        useCache -- cache all data in memory
+        useCache -- cache in memory the data covered by the selection
         **args -- used to create a selection
         """
 
@@ -502,18 +1271,120 @@ class solHandler( object ):
         # set axes names once to speed up calls
         self.axesNames = table.val.attrs['AXES'].split(',')
         # set axes values once to speed up calls (a bit of memory usage though)
+        # the axes indexes are built here once and shared with the other solHandlers of this table
         self.axes = {}
         for axis in self.getAxesNames():
             self.axes[axis] = table._f_get_child(axis)
+            axisIndex.get(self.axes[axis])
 
         self.selection = {}
         self.setSelection(**args)
 
         self.useCache = useCache
         if self.useCache:
+            # only the region covered by the initial selection is cached, val and weight are read
+            # the first time they are used and only the modified ones are written back
             logging.debug("Caching...")
-            self.cacheWeight = np.copy(self.t.weight)
-            self.cacheVal = np.copy(self.t.val)
+            self.cacheBox = []
+            for j, axisName in enumerate(self.getAxesNames()):
+                pos = np.atleast_1d(np.arange(self.getAxisLen(axisName, ignoreSelection=True))[self.selection[j]])
+                if len(pos) == 0: self.cacheBox.append((0, 0))
+                else: self.cacheBox.append((int(pos.min()), int(pos.max())+1))
+            self.cache = {'val': None, 'weight': None}
+            self.cacheDirty = {'val': None, 'weight': None}
+
+
+    def _getNode(self, name, write=False):
+        """
+        Return the val or weight array, from the working set if it is running (see startWorkingSet())
+        Keyword arguments:
+        name -- 'val' or 'weight'
+        write -- if true the data will be modified (default: False)
+        """
+        node = self.t._f_get_child(name)
+        if _workingSet is not None:
+            array = _workingSet.get(node, write)
+            if array is not None: return array
+        # arrays shared with a lazy snapshot are copied before the first write
+        if write: node = _unshare(node)
+        return node
+
+
+    def _cacheSelection(self, selection):
+        """
+        Return the selection relative to the cached region, None if the selection is not entirely inside it
+        Keyword arguments:
+        selection -- a selection relative to the whole table
+        """
+        relSelection = []
+        for sel, (first, last), axisName in zip(selection, self.cacheBox, self.getAxesNames()):
+            pos = np.arange(self.getAxisLen(axisName, ignoreSelection=True))[sel]
+            if np.size(pos) != 0 and (np.min(pos) < first or np.max(pos) >= last): return None
+            if isinstance(sel, slice):
+                if np.size(pos) == 0: relSelection.append(slice(0, 0))
+                elif sel.step is None or sel.step > 0: relSelection.append(slice(int(pos[0])-first, int(pos[-1])-first+1, sel.step))
+                else: relSelection.append(list(pos-first))
+            elif np.ndim(pos) == 0: relSelection.append(int(pos)-first)
+            else: relSelection.append(list(pos-first))
+        return relSelection
+
+
+    def _getCached(self, weight=False, selection=None, write=False):
+        """
+        Return the array and the selection to use to access the data through the cache.
+        If the selection is outside the cached region the cache is written back and the table is returned.
+        Keyword arguments:
+        weight -- if true use the weights instead that the vals (default: False)
+        selection -- the selection, relative to the whole table
+        write -- if true the selected data will be modified (default: False)
+        """
+        name = 'weight' if weight else 'val'
+        relSelection = self._cacheSelection(selection)
+        if relSelection is None:
+            # write back before accessing the table, if the table is modified the cached data are then reloaded
+            self._flushCache()
+            if write: self.cache[name] = None
+            return self._getNode(name, write), selection
+
+        if self.cache[name] is None:
+            with hdf5Lock:
+                # a copy also when reading from the working set, which is modified only by _flushCache()
+                dataVals = self._getNode(name)
+                self.cache[name] = dataVals[tuple([slice(first, last) for first, last in self.cacheBox])]
+                if isinstance(dataVals, np.ndarray): self.cache[name] = self.cache[name].copy()
+        if write:
+            if self.cacheDirty[name] is None:
+                self.cacheDirty[name] = [np.zeros(last-first, dtype=bool) for first, last in self.cacheBox]
+            for dirty, sel in zip(self.cacheDirty[name], relSelection):
+                dirty[sel] = True
+        return self.cache[name], relSelection
+
+
+    def _flushCache(self):
+        """
+        Write back the modified regions of the cached arrays
+        """
+        for name in ['val', 'weight']:
+            if self.cacheDirty[name] is None: continue
+            relSelection = []
+            selection = []
+            for dirty, (first, last) in zip(self.cacheDirty[name], self.cacheBox):
+                pos = np.where(dirty)[0]
+                if len(pos) == 0: break
+                if pos[-1] - pos[0] == len(pos) - 1:
+                    relSelection.append(slice(int(pos[0]), int(pos[-1])+1))
+                    selection.append(slice(int(pos[0])+first, int(pos[-1])+first+1))
+                else:
+                    relSelection.append(pos.tolist())
+                    selection.append((pos+first).tolist())
+            else:
+                logging.debug("Writing back %s (%s)." % (name, selection))
+                with hdf5Lock:
+                    dataVals = self._getNode(name, write=True)
+                    vals = _readSelection(self.cache[name], relSelection)
+                    _writeSelection(dataVals, selection, vals)
+                    if isinstance(dataVals, tables.Leaf): updateChecksums(dataVals, selection, vals)
+            self.cacheDirty[name] = None
 
 
     def getAddress(self):
@@ -550,31 +1421,40 @@ class solHandler( object ):
                 if not self.getAxisType(axis).char is 'S':
                     logging.warning("Cannot select on axis \""+axis+"\" with a regular expression. Use all available values.")
                     continue
-                self.selection[idx] = [i for i, item in enumerate(self.getAxisValues(axis)) if re.search(selVal, item)]
+                self.selection[idx] = [i for i, item in enumerate(self.getAxisValues(axis, ignoreSelection=True)) if re.search(selVal, item)]
 
                 # transform list of 1 element in a relative slice(), necessary when slicying and to always get an array back
                 if len(self.selection[idx]) == 1: self.selection[idx] = slice(self.selection[idx][0],self.selection[idx][0]+1)
 
-            # dict -> min max
-            elif type(selVal) is dict:
-                axisVals = self.getAxisValues(axis)
-                if 'min' in selVal and selVal['min'] > np.max(axisVals):
-                    logging.error("Selection with min > than maximum value. Use all available values.")
-                    continue
-                if 'max' in selVal and selVal['max'] < np.min(axisVals):
-                    logging.error("Selection with max < than minimum value. Use all available values.")
-                    continue
-                if 'min' in selVal and 'max' in selVal:
-                    self.selection[idx] = slice(np.where(axisVals >= selVal['min'])[0][0], np.where(axisVals <= selVal['max'])[0][-1]+1)
-                elif 'min' in selVal:
-                    self.selection[idx] = slice(np.where(axisVals >= selVal['min'])[0][0], None)
-                elif 'max' in selVal:
-                    self.selection[idx] = slice(0, np.where(axisVals <= selVal['max'])[0][-1]+1)
+            # dict -> min max (a list of dicts selects multiple ranges)
+            elif type(selVal) is dict or (type(selVal) is list and len(selVal) > 0 and all([type(v) is dict for v in selVal])):
+                index = axisIndex.get(self.getAxis(axis))
+                if type(selVal) is dict: selVal = [selVal]
+                ranges = []
+                for selRange in selVal:
+                    tol = selRange.get('tol', 0.)
+                    if 'min' in selRange and selRange['min']-tol > index.sortedVals[-1]:
+                        logging.error("Selection with min > than maximum value. Use all available values.")
+                        continue
+                    if 'max' in selRange and selRange['max']+tol < index.sortedVals[0]:
+                        logging.error("Selection with max < than minimum value. Use all available values.")
+                        continue
+                    if not 'min' in selRange and not 'max' in selRange:
+                        logging.error("Selection with a dict must have 'min' and/or 'max' entry. Use all available values.")
+                        continue
+                    thisRange = index.findRange(selRange.get('min'), selRange.get('max'), tol)
+                    if 'step' in selRange:
+                        if type(thisRange) is slice: thisRange = slice(thisRange.start, thisRange.stop, int(selRange['step']))
+                        else: thisRange = thisRange[::int(selRange['step'])]
+                    ranges.append(thisRange)
+
+                if ranges == []: continue
+                elif len(ranges) == 1 and type(ranges[0]) is slice: self.selection[idx] = ranges[0]
                 else:
-                    logging.error("Selection with a dict must have 'min' and/or 'max' entry. Use all available values.")
-                    continue
-                if 'step' in selVal:
-                    self.selection[idx] = slice(self.selection[idx].start, self.selection[idx].stop, selVal['step'])
+                    self.selection[idx] = sorted(set(itertools.chain(*[range(*r.indices(len(index.vals))) if type(r) is slice else r for r in ranges])))
+                    # transform list of continuous numbers in slices (faster)
+                    if len(self.selection[idx]) != 0 and len(self.selection[idx])-1 == self.selection[idx][-1] - self.selection[idx][0]:
+                        self.selection[idx] = slice(self.selection[idx][0], self.selection[idx][-1]+1)
 
             # single val/list -> exact matching
             else:
@@ -583,11 +1463,7 @@ class solHandler( object ):
                 # convert to correct data type (from parset everything is a str)
                 selVal = np.array(selVal, dtype=self.getAxisType(axis))
 
-                if len(selVal) == 1:
-                    # speedup in the common case of a single value
-                    self.selection[idx] = [self.getAxisValues(axis).tolist().index(selVal)]
-                else:
-                    self.selection[idx] = [i for i, item in enumerate(self.getAxisValues(axis)) if item in selVal]
+                self.selection[idx] = axisIndex.get(self.getAxis(axis)).find(selVal)
 
                 # transform list of 1 element in a relative slice(), necessary when slicying and to always get an array back
                 if len(self.selection[idx]) == 1: self.selection[idx] = slice(self.selection[idx][0], self.selection[idx][0]+1)
@@ -663,29 +1539,36 @@ class solHandler( object ):
         ignoreSelection -- if True returns the axis values without any selection active
         """
         try:
+            axisVals = axisIndex.get(self.getAxis(axis)).vals
             if ignoreSelection:
-                return self.getAxis(axis)[:]
+                return axisVals.copy()
             else:
                 axisIdx = self.getAxesNames().index(axis)
-                return self.getAxis(axis)[self.selection[axisIdx]]
+                return np.array(axisVals[self.selection[axisIdx]])
         except:
             logging.error('Axis \"'+axis+'\" not found.')
             return None
 
 
+    @_locked
     def addHistory(self, entry=""):
         """
         Adds entry to the table history with current date and time
 
         Since attributes cannot by default be larger than 64 kB, each
         history entry is stored in a separate attribute.
+        The attributes of a val shared with a lazy snapshot are shared too,
+        then the entry (and all the following ones) is stored in the soltab attributes.
 
         Keyword arguments:
         entry -- string to add to history list
         """
         import datetime
         current_time = str(datetime.datetime.now()).split('.')[0]
-        attrs = self.t.val.attrs._f_list("user")
+        if 'COW_LINKS' in _sharedAttrs(self.t.val) or \
+                any([attr[:-3] == 'HISTORY' for attr in self.t._v_attrs._f_list("user")]): attrSet = self.t._v_attrs
+        else: attrSet = self.t.val.attrs
+        attrs = attrSet._f_list("user")
         nums = []
         for attr in attrs:
             try:
@@ -695,7 +1578,7 @@ class solHandler( object ):
                 pass
         historyAttr = "HISTORY%03d" % min(list(set(range(1000)) - set(nums)))
 
-        self.t.val.attrs[historyAttr] = current_time + ": " + str(entry)
+        attrSet[historyAttr] = current_time + ": " + str(entry)
 
 
     def getHistory(self):
@@ -703,12 +1586,14 @@ class solHandler( object ):
         Returns the table history as a string with each entry separated by
         newlines
         """
-        attrs = self.t.val.attrs._f_list("user")
-        attrs.sort()
         history_list = []
-        for attr in attrs:
-            if attr[:-3] == 'HISTORY':
-                history_list.append(self.t.val.attrs[attr])
+        # the entries in the soltab attributes follow those of val
+        for attrSet in [_sharedAttrs(self.t.val), self.t._v_attrs]:
+            attrs = attrSet._f_list("user")
+            attrs.sort()
+            for attr in attrs:
+                if attr[:-3] == 'HISTORY':
+                    history_list.append(attrSet[attr])
         if len(history_list) == 0:
             history_str = ""
         else:
@@ -738,9 +1623,12 @@ class solWriter(solHandler):
             logging.error('Axis \"'+axis+'\" not found.')
 
         axisIdx = self.getAxesNames().index(axis)
+        self.axes[axis] = _unshare(self.getAxis(axis))
         self.getAxis(axis)[self.selection[axisIdx]] = vals
+        axisIndex.reset(self.getAxis(axis))
 
 
+    @_locked
     def setValues(self, vals, weight = False):
         """
         Save values in the val grid
@@ -749,46 +1637,28 @@ class solWriter(solHandler):
         weight -- if true store in the weights instead that in the vals (default: False)
         """
         if self.useCache:
-            if weight: dataVals = self.cacheWeight
-            else: dataVals = self.cacheVal
+            dataVals, selection = self._getCached(weight, self.selection, write=True)
         else:
-            if weight: dataVals = self.t.weight
-            else: dataVals = self.t.val
+            dataVals = self._getNode('weight' if weight else 'val', write=True)
+            selection = self.selection
 
         # NOTE: pytables has a nasty limitation that only one list can be applied when selecting.
         # Conversely, one can apply how many slices he wants.
         # Single values/contigous values are converted in slices in h5parm.
-        # This try/except implements a workaround for this limitation. Once the pytables will be updated, the except can be removed.
-        try:
-            # the float check allows quick reset of large arrays to a single value
-            if isinstance(vals, (np.floating, float)): dataVals[tuple(self.selection)] = vals
-            # the reshape is needed when saving e.g. [512] (vals shape) into [512,1,1] (selection output)
-            else: dataVals[tuple(self.selection)] = np.reshape(vals, dataVals[tuple(self.selection)].shape)
-        except:
-            logging.debug('Optimizing selection writing '+str(self.selection))
-            selectionListsIdx = [i for i, s in enumerate(self.selection) if type(s) is list]
-            subSelection = self.selection[:]
-            # create a subSelection also for the "vals" array
-            subSelectionForVals = [slice(None) for i in xrange(len(subSelection))]
-            # cycle across lists and save data index by index
-            for selectionListValsIter in itertools.product(*[self.selection[selectionListIdx] for selectionListIdx in selectionListsIdx[1:]]):
-                for i, selectionListIdx in enumerate(selectionListsIdx[1:]):
-                    # this is the sub selection which has a slice for every slice and a single value for every list
-                    subSelection[selectionListIdx] = selectionListValsIter[i]
-                    subSelectionForVals[selectionListIdx] = i
-                if type(vals) == float: dataVals[tuple(subSelection)] = vals
-                else: dataVals[tuple(subSelection)] = vals[tuple(subSelectionForVals)]
+        # _writeSelection() writes multiple lists with one write per run/chunk.
+        _writeSelection(dataVals, selection, vals)
+        if isinstance(dataVals, tables.Leaf): updateChecksums(dataVals, selection, vals)
 
+    @_locked
     def flush(self):
         """
-        Copy cached values into the table
+        Copy the modified cached values into the table
         """
         if not self.useCache:
             logging.error("Flushing non cached data.")
             sys.exit(1)
         logging.info("Writing results...")
-        self.t.weight[:] = self.cacheWeight
-        self.t.val[:] = self.cacheVal
+        self._flushCache()
 
 
 class solFetcher(solHandler):
@@ -817,6 +1687,7 @@ class solFetcher(solHandler):
             #return None
 
 
+    @_locked
     def getValues(self, retAxesVals=True, weight=False, reference=None):
         """
         Creates a simple matrix of values. Fetching a copy of all selected rows into memory.
@@ -830,35 +1701,31 @@ class solFetcher(solHandler):
         If selected, returns also the axes values
         """
 
+        inWorkingSet = False
+        mm = None
         if self.useCache:
-            if weight: dataVals = self.cacheWeight
-            else: dataVals = self.cacheVal
+            dataVals, selection = self._getCached(weight, self.selection)
         else:
-            if weight: dataVals = self.t.weight
-            else: dataVals = self.t.val
+            dataVals = self._getNode('weight' if weight else 'val')
+            selection = self.selection
+            inWorkingSet = isinstance(dataVals, np.ndarray)
+            # uncompressed contiguous data are read through a memory map, without copies on read-only files
+            if not inWorkingSet:
+                mm = _memmap(dataVals)
+                if mm is not None:
+                    readonly = dataVals._v_file.mode == 'r'
+                    dataVals = mm.view(np.ndarray)
 
         # apply the self.selection
         # NOTE: pytables has a nasty limitation that only one list can be applied when selecting.
         # Conversely, one can apply how many slices he wants.
         # Single values/contigous values are converted in slices in h5parm.
-        # This try/except implements a workaround for this limitation. Once the pytables will be updated, the except can be removed.
-        try:
-            dataVals = dataVals[tuple(self.selection)]
-        except:
-            logging.debug('Optimizing selection reading '+str(self.selection))
-            # for performances is important to minimize the fetched data
-            # convert all lists other then the first (pytables allowes one!) to slices
-            selectionListsIdx = [i for i, s in enumerate(self.selection) if type(s) is list]
-            firstSelection = self.selection[:]
-            for i in selectionListsIdx[1:]:
-                firstSelection[i] = slice(None)
-            # create a second selection using np.ix_
-            secondSelection = []
-            for i, sel in enumerate(self.selection):
-                if i == selectionListsIdx[0]: secondSelection.append(xrange(self.getAxisLen(self.getAxesNames()[i], ignoreSelection=False)))
-                elif type(sel) is list: secondSelection.append(sel)
-                elif type(sel) is slice: secondSelection.append(xrange(self.getAxisLen(self.getAxesNames()[i], ignoreSelection=False)))
-            dataVals = dataVals[tuple(firstSelection)][np.ix_(*secondSelection)]
+        # _readSelection() reads multiple lists with the minimal number of hyperslabs.
+        dataVals = _readSelection(dataVals, selection)
+        # the working set is modified only through setValues(), never through the returned data
+        if inWorkingSet: dataVals = np.array(dataVals)
+        # the pages of the map not modified by the caller would show the following writes to the file
+        elif mm is not None and not readonly and np.may_share_memory(dataVals, mm): dataVals = np.array(dataVals)
 
         if reference is not None:
             # TODO: flag when reference is flagged?
@@ -869,7 +1736,7 @@ class solFetcher(solHandler):
             elif not reference in self.getAxisValues('ant', ignoreSelection = True):
                 logging.error('Cannot find antenna '+reference+'. Ignore referencing.')
             else:
-                selection_stored = np.copy(self.selection)
+                selection_stored = list(self.selection)
                 antAxis = self.getAxesNames().index('ant')
                 self.selection[antAxis] = [list(self.getAxisValues('ant', ignoreSelection=True)).index(reference)]
                 dataValsRef = self.getValues(retAxesVals=False, reference=None)
@@ -892,16 +1759,25 @@ class solFetcher(solHandler):
         return dataVals, axisVals
 
 
-    def getValuesIter(self, returnAxes=[], weight=False, reference=None):
+    @_locked
+    def getValuesIter(self, returnAxes=[], weight=False, reference=None, memoryLimit=None, prefetch=0, blockHandler=None):
         """
         Return an iterator which yields the values matrix (with axes = returnAxes) iterating along the other axes.
         E.g. if returnAxes are ['freq','time'], one gets a interetion over all the possible NxM
         matrix where N are the freq and M the time dimensions. The other axes are iterated in the getAxesNames() order.
         Note that all the data are fetched in memory before returning them one at a time. This is quick.
+        If memoryLimit is set, data are instead read in blocks (aligned to the iterated axes and to the HDF5 chunks)
+        which are never larger than memoryLimit. With prefetch > 0 the next blocks are read by a background thread
+        while the caller works on the current one: the caller must not hold hdf5Lock while iterating (e.g. it
+        iterates inside "with hdf5Lock.released():"), otherwise the blocks are read without prefetch.
         Keyword arguments:
         returnAxes -- axes of the returned array, all others will be cycled
-
         weight -- if true return also the weights (default: False)
+        reference -- in case of phase solutions, reference to this station name
+        memoryLimit -- maximum memory (MB) used to read the data, None to read all the data at once (default: None)
+        prefetch -- number of blocks read in advance by a background thread, used only with memoryLimit (default: 0)
+        blockHandler -- function applied to each block of values/weights read, e.g. multiprocManager.share() to read
+        them into shared memory (default: None)
         Return:
         1) data ndarray of dim=dim(returnAxes) and with the axes ordered as in getAxesNames()
         2) (if weight == True) weigth ndarray of dim=dim(returnAxes) and with the axes ordered as in getAxesNames()
@@ -909,42 +1785,151 @@ class solFetcher(solHandler):
         {'axisname1':[axisvals1],'axisname2':[axisvals2],...}
         4) a selection which should be used to write this data back using a solWriter
         """
-        if weight: weigthVals = self.getValues(retAxesVals=False, weight=True, reference=None)
-        dataVals = self.getValues(retAxesVals=False, weight=False, reference=reference)
+        # compute the iteration plan once: axis values and absolute positions (in the full axis) of the selected
+        # elements, so that the generator has only to pick elements out of these arrays without touching the file
+        axesNames = self.getAxesNames()
+        axesVals = {}
+        iterAxes = [] # (position in getAxesNames(), axis values, absolute positions)
+        for j, axisName in enumerate(axesNames):
+            axesVals[axisName] = self.getAxisValues(axisName)
+            if not axisName in returnAxes:
+                absIdx = np.atleast_1d(np.arange(self.getAxisLen(axisName, ignoreSelection=True))[self.selection[j]])
+                iterAxes.append((j, axesVals[axisName], absIdx))
+        iterAxesDim = [len(absIdx) for j, vals, absIdx in iterAxes]
+
+        # blocks are read through a private solFetcher, so the selection of this one is never changed
+        # (the caller may use it while the next block is read in background)
+        blockFetcher = solFetcher(self.t)
+        if self.useCache:
+            blockFetcher.useCache = True
+            blockFetcher.cacheBox = self.cacheBox
+            blockFetcher.cache = self.cache
+            blockFetcher.cacheDirty = self.cacheDirty
 
-        # get dimensions of non-returned axis (in correct order)
-        iterAxesDim = [self.getAxisLen(axis) for axis in self.getAxesNames() if not axis in returnAxes]
+        def readBlock(blockSelection):
+            """
+            Read values (and weights) of a block
+            """
+            with hdf5Lock:
+                blockFetcher.selection = blockSelection
+                if weight: weigthVals = blockFetcher.getValues(retAxesVals=False, weight=True, reference=None)
+                else: weigthVals = None
+                dataVals = blockFetcher.getValues(retAxesVals=False, weight=False, reference=reference)
+            if blockHandler is not None:
+                dataVals = blockHandler(dataVals)
+                if weight: weigthVals = blockHandler(weigthVals)
+            return dataVals, weigthVals
+
+        if memoryLimit is None:
+            # all data in a single block, read now
+            blockShape = iterAxesDim
+            block = readBlock(list(self.selection))
+        else:
+            # blocks span the whole return axes and as many chunks of the iterated axes as fit into the memory limit
+            itemsize = self.t.val.dtype.itemsize
+            if weight: itemsize += self.t.weight.dtype.itemsize
+            iterSize = itemsize * int(np.prod([self.getAxisLen(axisName) for axisName in axesNames if axisName in returnAxes]))
+            chunkShape = self.t.val.chunkshape
+            if chunkShape is None: iterChunk = [1]*len(iterAxes)
+            else: iterChunk = [chunkShape[j] for j, vals, absIdx in iterAxes]
+            if iterSize * int(np.prod([min(c, d) for c, d in zip(iterChunk, iterAxesDim)])) > memoryLimit*1024*1024:
+                iterChunk = [1]*len(iterAxes)
+            if iterSize > memoryLimit*1024*1024:
+                logging.warning('A single iteration needs %.1f MB, more than the memory limit of %.1f MB.' % (iterSize/1024.**2, memoryLimit))
+            blockShape = computeBlockShape(iterAxesDim, iterChunk, itemsize=iterSize, maxBlockSize=int(memoryLimit*1024*1024))
+            logging.debug('Reading blocks of shape %s (iterated axes: %s).' % (blockShape, [axesNames[j] for j, vals, absIdx in iterAxes]))
+
+        def getBlockSelection(blockIdx):
+            """
+            Return the selection of a block, contiguous elements are read with a slice
+            """
+            blockSelection = list(self.selection)
+            for i, (j, vals, absIdx) in enumerate(iterAxes):
+                pos = absIdx[blockIdx[i]]
+                if pos[-1] - pos[0] == len(pos) - 1: blockSelection[j] = slice(int(pos[0]), int(pos[-1])+1)
+                else: blockSelection[j] = pos.tolist()
+            return blockSelection
+
+        def getBlocks():
+            """
+            Iterate over the blocks returning (block indexes, values, weights)
+            """
+            if memoryLimit is None:
+                yield (tuple([slice(0, d) for d in iterAxesDim]),) + block
+                return
+
+            # the prefetch thread could read only while the caller waits for the next block
+            if prefetch > 0 and hdf5Lock.held():
+                logging.warning('Prefetch disabled: the data are iterated holding the h5parm lock.')
+            if prefetch <= 0 or hdf5Lock.held():
+                for blockIdx in iterBlocks(iterAxesDim, blockShape):
+                    yield (blockIdx,) + readBlock(getBlockSelection(blockIdx))
+                return
+
+            # a background thread fills the queue with the next blocks, pytables releases the GIL while reading
+            logging.info('Prefetching data in background (queue depth: %i blocks).' % prefetch)
+            queue = Queue.Queue(maxsize=prefetch)
+            stop = threading.Event()
+
+            def put(item):
+                """
+                Put an item in the queue, return False if the iteration was stopped in the meanwhile
+                """
+                while not stop.is_set():
+                    try:
+                        queue.put(item, timeout=0.1)
+                        return True
+                    except Queue.Full: pass
+                return False
+
+            def prefetcher():
+                try:
+                    for blockIdx in iterBlocks(iterAxesDim, blockShape):
+                        if not put((blockIdx,) + readBlock(getBlockSelection(blockIdx))): return
+                    put(None)
+                except:
+                    put(sys.exc_info())
+
+            thread = threading.Thread(target=prefetcher)
+            thread.daemon = True
+            thread.start()
+            waitTime = 0.
+            nBlocks = 0
+            try:
+                while True:
+                    startTime = time.time()
+                    # the prefetch thread needs the lock, which may be held by this thread (see losoto.scheduler)
+                    with hdf5Lock.released(): item = queue.get()
+                    waitTime += time.time() - startTime
+                    if item is None: break
+                    # an exception in the prefetch thread
+                    if len(item) == 3 and isinstance(item[1], BaseException): raise item[0], item[1], item[2]
+                    nBlocks += 1
+                    yield item
+            finally:
+                stop.set()
+                with hdf5Lock.released(): thread.join()
+                logging.debug('Prefetched %i blocks, waited %.2f s for data.' % (nBlocks, waitTime))
 
         # generator to cycle over all the combinations of iterAxes
-        # it "simply" gets the indexes of this particular combination of iterAxes
-        # and use them to refine the selection.
+        # data are views of the block values in memory, the selection to write back uses a
+        # single element slice of the full axis for each iterated axis
         def g():
-            for axisIdx in np.ndindex(tuple(iterAxesDim)):
-                refSelection = []
-                returnSelection = []
-                thisAxesVals = {}
-                i = 0
-                for j, axisName in enumerate(self.getAxesNames()):
-                    if axisName in returnAxes:
-                        thisAxesVals[axisName] = self.getAxisValues(axisName)
-                        # add a slice with all possible values (main selection will be preapplied)
-                        refSelection.append(slice(0,self.getAxisLen(axisName), None))
-                        # for the return selection use the "main" selection for the return axes
-                        returnSelection.append(self.selection[j])
+            refSelection = [slice(None)] * len(axesNames)
+            returnSelection = list(self.selection)
+            for blockIdx, dataVals, weigthVals in getBlocks():
+                for axisIdx in np.ndindex(tuple([b.stop - b.start for b in blockIdx])):
+                    # return axes values are copied as some operations modify them in place
+                    thisAxesVals = dict((axisName, np.copy(axesVals[axisName])) for axisName in axesNames if axisName in returnAxes)
+                    for i, (j, vals, absIdx) in enumerate(iterAxes):
+                        thisAxesVals[axesNames[j]] = vals[blockIdx[i].start + axisIdx[i]]
+                        refSelection[j] = axisIdx[i]
+                        returnSelection[j] = slice(int(absIdx[blockIdx[i].start + axisIdx[i]]), int(absIdx[blockIdx[i].start + axisIdx[i]])+1)
+                    data = dataVals[tuple(refSelection)]
+                    if weight:
+                        weights = weigthVals[tuple(refSelection)]
+                        yield (data, weights, thisAxesVals, list(returnSelection))
                     else:
-                        #TODO: the iteration axes are not into a 1 element array, is it a problem?
-                        thisAxesVals[axisName] = self.getAxisValues(axisName)[axisIdx[i]]
-                        # add this index to the refined selection, this will return a single value for this axis
-                        refSelection.append(axisIdx[i])
-                        # for the return selection use the complete axis and find the correct index
-                        returnSelection.append( list(np.where( self.getAxisValues(axisName, ignoreSelection=True) == thisAxesVals[axisName] )[0]) )
-                        i += 1
-                # costly command
-                data = dataVals[tuple(refSelection)]
-                if weight:
-                    weights = weigthVals[tuple(refSelection)]
-                    yield (data, weights, thisAxesVals, returnSelection)
-                else:
-                    yield (data, thisAxesVals, returnSelection)
+                        yield (data, thisAxesVals, list(returnSelection))
 
         return g()
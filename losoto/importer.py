@@ -117,7 +117,7 @@ def parmdbToAxes(solEntry):
 
 
 def create_h5parm(instrumentdbFiles, antennaFile, fieldFile, skydbFile,
-                  h5parmFile, complevel, solsetName, globaldbFile=None, verbose=False):
+                  h5parmFile, complevel, solsetName, globaldbFile=None, verbose=False, complib='zlib'):
     """
     Create the h5parm file.
     Input:
@@ -130,10 +130,11 @@ def create_h5parm(instrumentdbFiles, antennaFile, fieldFile, skydbFile,
        solsetName - Name of the solution set. Usually "sol###".
        globaldbFile (optional) - Name of the globaldbFile. Used only for 
          logging purposes.
+       complib (optional) - compression library (default: zlib).
     """
     
     # open/create the h5parm file and the solution-set
-    h5parm = h5parm_mod(h5parmFile, readonly = False, complevel = complevel)
+    h5parm = h5parm_mod(h5parmFile, readonly = False, complevel = complevel, complib = complib)
     
     solset = h5parm.makeSolset(solsetName)
     
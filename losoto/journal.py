@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Journal of the steps run on a h5parm, so that a parset can be resumed without repeating completed steps
+
+import logging
+import json
+import hashlib
+import time
+import numpy as np
+from losoto.h5parm import getWorkingSet
+from losoto.operations_lib import getParSoltabs
+from losoto.scheduler import stepAccess
+
+# options which change how a step is run but not its results
+runOptions = ['Ncpu', 'Executor', 'Scheduler', 'ParallelSoltabs', 'WorkingSet', 'Fuse', 'MemoryLimit', 'TaskSize', 'Prefetch', 'Checkpoint', 'Journal', 'CacheDir', 'CacheSize', 'Checksums']
+
+def parsetHash( step, parset ):
+    """
+    Return the hash of the parset options used by a step: those of its block and the global ones
+    """
+    stepPrefix = '.'.join( [ "LoSoTo.Steps", step, '' ] )
+    items = []
+    for key in sorted(parset.keys()):
+        if key.startswith(stepPrefix): name = key[len(stepPrefix):]
+        elif key.startswith('LoSoTo.') and not key.startswith('LoSoTo.Steps'): name = key[len('LoSoTo.'):]
+        else: continue
+        if name in runOptions: continue
+        items.append( key + '=' + parset.getString(key) )
+    return hashlib.sha1( '\n'.join(items) ).hexdigest()
+
+
+def soltabHash( soltab, blockSize=64*1024*1024 ):
+    """
+    Return the hash of the content of a soltab (values, weights and axes), the arrays are read in blocks of blockSize bytes.
+    The block checksums (see h5parm.computeChecksums()) are derived from the data and are not hashed.
+    """
+    h = hashlib.sha1()
+    for leaf in sorted(soltab._f_walknodes('Leaf'), key=lambda leaf: leaf._v_name):
+        if leaf._v_name in ['val_crc', 'weight_crc']: continue
+        h.update( '%s %s %s' % (leaf._v_name, leaf.dtype, leaf.shape) )
+        if len(leaf.shape) == 0 or leaf.nrows == 0:
+            h.update( np.asarray(leaf.read()).tostring() )
+            continue
+        rows = max(1, blockSize / max(1, leaf.size_in_memory / leaf.nrows))
+        for start in xrange(0, leaf.nrows, rows):
+            h.update( np.asarray(leaf.read(start, min(start+rows, leaf.nrows))).tostring() )
+    return h.hexdigest()
+
+
+class journal( object ):
+    """
+    Steps completed on a h5parm, stored in its hidden group /_p_journal with one attribute per step.
+    Each entry records the hash of the parset options of the step and of the soltabs it reads and writes.
+    Before a step runs, the soltabs it writes are snapshot in /_p_journal/snapshot (only the arrays
+    the step writes are then actually copied, see h5parm.snapshotSoltab()): if the run dies,
+    the next run restores them (and removes the soltabs created by the step) before retrying the step.
+    """
+
+    def __init__(self, H, restart=False):
+        """
+        Keyword arguments:
+        H -- the h5parm (open in write mode)
+        restart -- if True the previous journal is ignored and all the steps run again
+        """
+        self.H = H
+        if not '_p_journal' in self.H.H.root._v_hidden:
+            self.H.H.create_group('/', '_p_journal', 'LoSoTo journal of completed steps')
+        self.group = self.H.H.get_node('/_p_journal')
+
+        self.entries = [json.loads(self.group._v_attrs[attr]) for attr in self._attrs()]
+        # hash of the soltabs as left by the journaled steps
+        self.hashes = {}
+        # index of the next entry to compare with the parset steps
+        self.position = 0
+        self.current = None
+
+        if restart and self.entries != []:
+            logging.info('Ignoring the journal of %i steps.' % len(self.entries))
+            self._truncate(0)
+        if self.entries != [] and self.entries[-1]['status'] == 'running':
+            self._rollback()
+        if self.entries != []:
+            self._verify()
+
+    def _attrs(self):
+        return sorted([attr for attr in self.group._v_attrs._f_list('user') if attr.startswith('STEP')])
+
+    def _save(self, i, entry):
+        self.group._v_attrs['STEP%03d' % i] = json.dumps(entry)
+        # the journal must be on disk before the data are modified
+        self.H.H.flush()
+
+    def _truncate(self, i):
+        for attr in self._attrs()[i:]: del self.group._v_attrs[attr]
+        self.entries = self.entries[:i]
+        self.H.H.flush()
+
+    def _listSoltabs(self):
+        return ['/'.join([solset, soltab]) for solset in self.H.getSolsets() for soltab in self.H.getSoltabs(solset) \
+                    if not soltab in ['antenna', 'source']]
+
+    def _flushWorkingSet(self):
+        # snapshots and hashes are made of the data on disk
+        if getWorkingSet() is not None: getWorkingSet().flush(self.H.H.filename)
+
+    def _removeSnapshot(self):
+        if 'snapshot' in self.group:
+            for solset in self.group.snapshot._v_groups.values():
+                for soltab in solset._v_groups.values(): self.H.delSoltab(soltab=soltab)
+            self.group.snapshot._f_remove(recursive=True)
+        self.H.H.flush()
+
+    def _rollback(self):
+        """
+        Restore the h5parm as it was before the step which did not complete
+        """
+        entry = self.entries[-1]
+        logging.warning('Step \'%s\' did not complete in the previous run: restoring its soltabs.' % entry['step'])
+        for ss_st in self._listSoltabs():
+            if not ss_st in entry['soltabs'] or ss_st in entry['snapshot']:
+                solset, soltab = ss_st.split('/')
+                self.H.delSoltab(solset, soltab)
+        for solset in self.H.getSolsets().keys():
+            if not solset in entry['solsets'] and self.H.getSoltabs(solset) == {}:
+                self.H.getSolset(solset)._f_remove(recursive=True)
+        for ss_st in map(str, entry['snapshot']):
+            solset, soltab = ss_st.split('/')
+            self.H.snapshotSoltab(soltab=self.H.H.get_node('/_p_journal/snapshot/'+ss_st), outSolset=solset, outSoltab=soltab, lazy=True)
+        self._removeSnapshot()
+        self._truncate(len(self.entries)-1)
+
+    def _verify(self):
+        """
+        Check that the soltabs were not modified after the last run, otherwise the journal is discarded
+        """
+        hashes = {}
+        for entry in self.entries: hashes.update(entry['output'])
+        soltabs = self._listSoltabs()
+        self._flushWorkingSet()
+        for ss_st, h in hashes.iteritems():
+            if not ss_st in soltabs: continue
+            if soltabHash( self.H.H.get_node('/'+ss_st) ) != h:
+                logging.warning('Soltab %s was modified after the last run: ignoring the journal, all the steps run again.' % ss_st)
+                self._truncate(0)
+                return
+
+    def _access(self, step, op, parset):
+        """
+        Return the soltabs read and written by a step, all its soltabs are considered written if unknown
+        """
+        access = stepAccess( step, op, parset, self.H )
+        if access is None:
+            soltabs = set(getParSoltabs( step, parset, self.H ))
+            access = (soltabs, soltabs)
+        soltabs = self._listSoltabs()
+        return set([s for s in access[0] if s in soltabs]), set([s for s in access[1] if s in soltabs])
+
+    def _hash(self, ss_st):
+        if not ss_st in self.hashes: self.hashes[ss_st] = soltabHash( self.H.H.get_node('/'+ss_st) )
+        return self.hashes[ss_st]
+
+    def start(self, step, op, parset):
+        """
+        Called before a step runs, return True if the step was completed by a previous run and must be skipped
+        """
+        pHash = parsetHash( step, parset )
+        if self.position < len(self.entries):
+            entry = self.entries[self.position]
+            if entry['step'] == step and entry['op'] == op and entry['parset'] == pHash:
+                logging.info('Step \'%s\' completed in a previous run, skipping it.' % step)
+                self.hashes.update(entry['output'])
+                self.position += 1
+                return True
+            logging.info('Step \'%s\' differs from the journal: discarding %i journaled steps.' % (step, len(self.entries)-self.position))
+            self._truncate(self.position)
+
+        self._flushWorkingSet()
+        reads, writes = self._access( step, op, parset )
+        self.current = {'step': step, 'op': op, 'parset': pHash, 'status': 'running', 'start': time.time(),
+                'input': dict([(s, self._hash(s)) for s in reads | writes]),
+                'soltabs': self._listSoltabs(), 'solsets': self.H.getSolsets().keys(), 'snapshot': sorted(writes)}
+        self._removeSnapshot()
+        for ss_st in writes:
+            solset, soltab = ss_st.split('/')
+            if not '/_p_journal/snapshot/'+solset in self.H.H:
+                self.H.H.create_group('/_p_journal/snapshot', solset, createparents=True)
+            self.H.snapshotSoltab(solset, soltab, outSolset=self.H.H.get_node('/_p_journal/snapshot/'+solset), outSoltab=soltab, lazy=True)
+        self._save(len(self.entries), self.current)
+        self.entries.append(self.current)
+        return False
+
+    def done(self, returncode=0):
+        """
+        Called when a step is completed
+        """
+        self._flushWorkingSet()
+        entry = self.current
+        soltabs = self._listSoltabs()
+        # the soltabs written or created by the step
+        for ss_st in entry['snapshot'] + [s for s in soltabs if not s in entry['soltabs']]:
+            self.hashes.pop(ss_st, None)
+        for ss_st in self.hashes.keys():
+            if not ss_st in soltabs: del self.hashes[ss_st]
+        entry['output'] = dict([(s, self._hash(s)) for s in entry['input'].keys() + soltabs if s in soltabs and \
+                (s in entry['input'] or not s in entry['soltabs'])])
+        entry['status'] = 'done'
+        entry['returncode'] = returncode
+        self._save(len(self.entries)-1, entry)
+        self._removeSnapshot()
+        self.position = len(self.entries)
+        self.current = None
@@ -19,13 +19,20 @@ class timer(object):
         self.operation = operation
 
     def __enter__(self):
+        from losoto.operations_lib import getPool
         self.log.info("--> Starting \'" + self.step + "\' step (operation: " + self.operation + ").")
         self.start = time.time()
         self.startcpu = time.clock()
+        self.pool = getPool()
+        if self.pool is not None: self.startbusy = self.pool.busyTime
 
     def __exit__(self, type, value, tb):
 
         if type is not None:
             raise type, value, tb
         self.log.info("Time for this step: %i s (cpu: %i s)." % ( ( time.time() - self.start), (time.clock() - self.startcpu) ))
+        if self.pool is not None and self.pool.busyTime > self.startbusy:
+            busy = self.pool.busyTime - self.startbusy
+            self.log.info("Pool utilization: %i%% of %i processes (busy: %i s)." % \
+                    ( 100.*busy/(self.pool.procs*max(time.time() - self.start, 1e-6)), self.pool.procs, busy ))
 
@@ -14,11 +14,12 @@ logging.debug('Loading ABS module.')
 def run( step, parset, H ):
 
     import numpy as np
-    from losoto.h5parm import solFetcher, solWriter
+    from losoto.h5parm import solFetcher, solWriter, hdf5Lock
 
     soltabs = getParSoltabs( step, parset, H )
+    threads = getParParallelSoltabs( step, parset )
 
-    for soltab in openSoltabs( H, soltabs ):
+    def runSoltab(soltab):
 
         logging.info("Taking ABSolute value of soltab: "+soltab._v_name)
 
@@ -32,15 +33,36 @@ def run( step, parset, H ):
         sf.setSelection(**userSel)
 
         vals = sf.getValues(retAxesVals = False)
-        count = np.count_nonzero(vals<0)
+        with hdf5Lock.released():
+            count = np.count_nonzero(vals<0)
 
-        logging.info('Abs: %i points initially negative (%f %%)' % (count,100*float(count)/np.count_nonzero(vals)))
+            logging.info('Abs: %i points initially negative (%f %%)' % (count,100*float(count)/np.count_nonzero(vals)))
 
-        # writing back the solutions
-        sw.setValues(np.abs(vals))
+            # writing back the solutions
+            sw.setValues(np.abs(vals))
 
         sw.addHistory('ABSolute value taken')
-        
-    return 0
+        return 0
 
+    return runSoltabs( runSoltab, openSoltabs( H, soltabs ), threads )
 
+
+
+
+def kernel( step, parset, H, soltab ):
+    """
+    Return the step in fusable form (see losoto.fusion)
+    """
+    import numpy as np
+
+    counts = [0, 0] # negative and non-zero points
+
+    def funct(vals, weights, coord, selection):
+        counts[0] += np.count_nonzero(vals<0)
+        counts[1] += np.count_nonzero(vals)
+        np.abs(vals, out=vals)
+
+    def finish():
+        logging.info('Abs: %i points initially negative (%f %%)' % (counts[0],100*float(counts[0])/counts[1]))
+
+    return funct, None, 'ABSolute value taken', finish, False
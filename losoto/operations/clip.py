@@ -11,12 +11,50 @@ from losoto.operations_lib import *
 
 logging.debug('Loading CLIP module.')
 
+def clip(vals, weights, selection, clipLevel, log, outQueue=None):
+    """
+    Flag the data which are more than clipLevel times the rms away from the median
+    vals = the data
+    weights = the weights to convert into flags (modified)
+    
+    return: weights, selection and the number of flagged data before and after
+    """
+    import numpy as np
+
+    before_count=(len(weights)-np.count_nonzero(weights))
+
+    # first find the median and standard deviation
+    if (weights == 0).all():
+        valmedian = 0
+    else:
+        if log:
+            valmedian = np.median(np.log10(vals[(weights != 0)]))
+            rms = np.std(np.log10(vals[(weights != 0)]))
+            np.putmask(weights, np.abs(np.log10(vals)-valmedian) > rms * clipLevel, 0)
+        else:
+            valmedian = np.median(vals[(weights != 0)])
+            rms = np.std(vals[(weights != 0)])
+            np.putmask(weights, np.abs(vals-valmedian) > rms * clipLevel, 0)
+
+    after_count=(len(weights)-np.count_nonzero(weights))
+
+    outQueue.put([weights, selection, before_count, after_count])
+
+
 def run( step, parset, H ):
 
     import numpy as np
-    from losoto.h5parm import solFetcher, solWriter
+    from losoto.h5parm import solFetcher, solWriter, hdf5Lock
 
     soltabs = getParSoltabs( step, parset, H )
+    threads = getParParallelSoltabs( step, parset )
+    memoryLimit = getParMemoryLimit( step, parset )
+    prefetch = getParPrefetch( step, parset )
+    ncpu = parset.getInt('.'.join(["LoSoTo.Ncpu"]), 1 )
+    taskSize = getParTaskSize( step, parset )
+    executor = getParExecutor( step, parset )
+    # with a memory limit the data are sent to the workers through the queues
+    sharedMemory = parset.getBool('.'.join(["LoSoTo.SharedMemory"]), True ) and memoryLimit is None
 
     axesToClip = parset.getStringVector('.'.join(["LoSoTo.Steps", step, "Axes"]), [] )
     clipLevel = parset.getFloat('.'.join(["LoSoTo.Steps", step, "ClipLevel"]), 0. )
@@ -29,7 +67,7 @@ def run( step, parset, H ):
         logging.error("Please specify factor above/below median at which to clip.")
         return 1
 
-    for soltab in openSoltabs( H, soltabs ):
+    def runSoltab(soltab):
 
         logging.info("Clipping soltab: "+soltab._v_name)
 
@@ -41,51 +79,50 @@ def run( step, parset, H ):
             userSel[axis] = getParAxis( step, parset, H, axis )
         sf.setSelection(**userSel)
 
-        # some checks
-        for i, axis in enumerate(axesToClip[:]):
+        # some checks (the axes are checked for each soltab, which can be processed at the same time)
+        soltabAxes = []
+        for axis in axesToClip:
             if axis not in sf.getAxesNames():
-                del axesToClip[i]
                 logging.warning('Axis \"'+axis+'\" not found. Ignoring.')
+            else: soltabAxes.append(axis)
 
         if sf.getType() != 'amplitude':
             logging.error('CLIP is for "amplitude" tables, not %s.' % sf.getType())
-            continue
+            return 0
 
-        sw = solWriter(soltab, useCache=True) # remember to flush()
+        # with a memory limit the data are written directly on disk, otherwise only the selection is cached
+        sw = solWriter(soltab, useCache=memoryLimit is None, **userSel) # remember to flush()
+
+        # start processes for multi-thread
+        mpm = multiprocManager(ncpu, clip, sharedMemory=sharedMemory, executor=executor)
 
         before_count=0
         after_count=0
         total=0
-        for vals, weights, coord, selection in sf.getValuesIter(returnAxes=axesToClip, weight = True):
-
-            total+=len(vals)
-            before_count+=(len(weights)-np.count_nonzero(weights))
-
-            # first find the median and standard deviation
-            if (weights == 0).all():
-                valmedian = 0
-            else:
-                if log:
-                    valmedian = np.median(np.log10(vals[(weights != 0)]))
-                    rms = np.std(np.log10(vals[(weights != 0)]))
-                    np.putmask(weights, np.abs(np.log10(vals)-valmedian) > rms * clipLevel, 0)
-                else:
-                    valmedian = np.median(vals[(weights != 0)])
-                    rms = np.std(vals[(weights != 0)])
-                    np.putmask(weights, np.abs(vals-valmedian) > rms * clipLevel, 0)
-        
-            after_count+=(len(weights)-np.count_nonzero(weights))
-
-            # writing back the solutions
-            sw.selection = selection
-            sw.setValues(weights, weight=True)
-
-        sw.addHistory('CLIP (over %s with %s sigma cut)' % (axesToClip, clipLevel))
+        jobs = ([vals, weights, selection, clipLevel, log] \
+                for vals, weights, coord, selection in sf.getValuesIter(returnAxes=soltabAxes, weight=True, \
+                    memoryLimit=memoryLimit, prefetch=prefetch, blockHandler=mpm.share))
+
+        with hdf5Lock.released():
+            for weights, selection, before, after in mpm.map(jobs, taskSize=taskSize):
+
+                total+=len(weights)
+                before_count+=before
+                after_count+=after
+
+                # writing back the solutions
+                sw.selection = selection
+                sw.setValues(weights, weight=True)
+
+        mpm.wait()
+
+        sw.addHistory('CLIP (over %s with %s sigma cut)' % (soltabAxes, clipLevel))
         logging.info('Clip, flagged data: %f %% -> %f %%' \
                 % (100.*before_count/total, 100.*after_count/total))
 
-        sw.flush()
-        
-    return 0
+        if sw.useCache: sw.flush()
+        return 0
+
+    return runSoltabs( runSoltab, openSoltabs( H, soltabs ), threads )
 
 
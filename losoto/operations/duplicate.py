@@ -13,11 +13,11 @@ def run( step, parset, H ):
     Copy values from a table to another (of the same kind)
     If tables have different sampling, then resample the values
     """
-    import numpy as np
-    from losoto.h5parm import solFetcher, solWriter
+    from losoto.h5parm import solWriter
     
     inTable = parset.getString('.'.join(["LoSoTo.Steps", step, "InTable"]), '' ) # complete solset/soltab
     outTable = parset.getString('.'.join(["LoSoTo.Steps", step, "OutTable"]), '' ) # complete solset/soltab or ''
+    lazy = parset.getBool('.'.join(["LoSoTo.Steps", step, "Lazy"]), False ) # copy the arrays only when one of the tables writes them
 
     if inTable == '':
         logging.error('InTable is undefined.')
@@ -31,11 +31,8 @@ def run( step, parset, H ):
         outTableName = outTable.split('/')[1]
 
     ss, st = inTable.split('/')
-    sf = solFetcher(H.getSoltab(ss, st))
-
-    t = H.makeSoltab(solset = outSolsetName, soltype = sf.getType(), soltab = outTableName, axesNames=sf.getAxesNames(), \
-        axesVals=[sf.getAxisValues(axisName) for axisName in sf.getAxesNames()], \
-        vals=sf.getValues(retAxesVals = False), weights=sf.getValues(weight = True, retAxesVals = False), parmdbType=sf.t._v_attrs['parmdb_type'])
+    # the table is copied by HDF5 without reading it in memory
+    t = H.snapshotSoltab(ss, st, outSolset = outSolsetName, outSoltab = outTableName, lazy = lazy)
 
     sw = solWriter(t)
     sw.addHistory('DUPLICATE (from table %s)' % (inTable))
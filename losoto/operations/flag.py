@@ -243,6 +243,7 @@ def flag(vals, weights, coord, solType, order, mode, preflagzeros, maxCycles, ma
     # check if everything flagged
     if (weights == 0).all() == True:
         logging.debug('Percentage of data flagged/replaced (%s): already completely flagged' % (removeKeys(coord, axesToFlag)))
+        if not replace: vals = None # not written back, do not send them
         outQueue.put([vals, weights, selection])
         return
 
@@ -279,13 +280,14 @@ def flag(vals, weights, coord, solType, order, mode, preflagzeros, maxCycles, ma
         logging.debug('Percentage of data flagged/replaced (%s): %.3f -> %.3f %% (rms: %.5f)' \
             % (clean_coord, initPercentFlag, percentFlagged(weights), rms))
 
+    if not replace: vals = None # not written back, do not send them
     outQueue.put([vals, weights, selection])
 #    return vals, weights, selection
         
             
 def run( step, parset, H ):
 
-    from losoto.h5parm import solFetcher, solWriter
+    from losoto.h5parm import solFetcher, solWriter, hdf5Lock
 
     soltabs = getParSoltabs( step, parset, H )
 
@@ -302,6 +304,12 @@ def run( step, parset, H ):
     mode = parset.getString('.'.join(["LoSoTo.Steps", step, "Mode"]), 'smooth' )
     ref = parset.getString('.'.join(["LoSoTo.Steps", step, "Reference"]), '' )
     ncpu = parset.getInt('.'.join(["LoSoTo.Ncpu"]), 1 )
+    taskSize = getParTaskSize( step, parset )
+    memoryLimit = getParMemoryLimit( step, parset )
+    # with a memory limit the data are sent to the workers through the queues
+    sharedMemory = parset.getBool('.'.join(["LoSoTo.SharedMemory"]), True ) and memoryLimit is None
+    prefetch = getParPrefetch( step, parset )
+    executor = getParExecutor( step, parset )
 
     if ref == '': ref = None
 
@@ -324,12 +332,11 @@ def run( step, parset, H ):
     for soltab in openSoltabs( H, soltabs ):
 
         # start processes for multi-thread
-        mpm = multiprocManager(ncpu, flag)
+        mpm = multiprocManager(ncpu, flag, sharedMemory=sharedMemory, executor=executor)
 
         logging.info("Flagging soltab: "+soltab._v_name)
 
         sf = solFetcher(soltab)
-        sw = solWriter(soltab, useCache=True) # remember to flush!
 
         # axis selection
         userSel = {}
@@ -337,6 +344,9 @@ def run( step, parset, H ):
             userSel[axis] = getParAxis( step, parset, H, axis )
         sf.setSelection(**userSel)
 
+        # with a memory limit the data are written directly on disk, otherwise only the selection is cached
+        sw = solWriter(soltab, useCache=memoryLimit is None, **userSel) # remember to flush!
+
         for axisToFlag in axesToFlag:
             if axisToFlag not in sf.getAxesNames():
                 logging.error('Axis \"'+axis+'\" not found.')
@@ -352,20 +362,23 @@ def run( step, parset, H ):
         solType = sf.getType()
 
         # fill the queue (note that sf and sw cannot be put into a queue since they have file references)
-        for vals, weights, coord, selection in sf.getValuesIter(returnAxes=axesToFlag, weight=True, reference=ref):
-            mpm.put([vals, weights, coord, solType, order, mode, preflagzeros, maxCycles, maxRms, maxRmsNoise, windowNoise, fixRmsNoise, replace, axesToFlag, selection])
+        # and write the results while they are ready
+        jobs = ([vals, weights, coord, solType, order, mode, preflagzeros, maxCycles, maxRms, maxRmsNoise, windowNoise, fixRmsNoise, replace, axesToFlag, selection] \
+                for vals, weights, coord, selection in sf.getValuesIter(returnAxes=axesToFlag, weight=True, reference=ref, \
+                memoryLimit=memoryLimit, prefetch=prefetch, blockHandler=mpm.share))
+
+        with hdf5Lock.released():
+            for v, w, sel in mpm.map(jobs, taskSize=taskSize):
+                sw.selection = sel
+                if replace:
+                    # rewrite solutions (flagged values are overwritten)
+                    sw.setValues(v, weight=False)
+                else:
+                    sw.setValues(w, weight=True)
 
         mpm.wait()
-        
-        for v, w, sel in mpm.get():
-            sw.selection = sel
-            if replace:
-                # rewrite solutions (flagged values are overwritten)
-                sw.setValues(v, weight=False)
-            else:
-                sw.setValues(w, weight=True)
-        
-        sw.flush()
+
+        if sw.useCache: sw.flush()
         sw.addHistory('FLAG (over %s with %s sigma cut)' % (axesToFlag, maxRms))
 
         del sw
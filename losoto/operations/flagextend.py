@@ -30,7 +30,8 @@ def flag(weights, coord, axesToExt, selection, percent=90, size=[0], cycles=3, o
         import scipy.ndimage
         initialPercent = 100.*(np.size(weights)-np.count_nonzero(weights))/np.size(weights)
 
-        # if size=0 then extend to all axis
+        # if size=0 then extend to all axis (size is shared by the jobs run in threads)
+        size = list(size)
         for i, s in enumerate(size):
             if s == 0: size[i] = weights.shape[i]
 
@@ -58,6 +59,8 @@ def run( step, parset, H ):
     percent = parset.getFloat('.'.join(["LoSoTo.Steps", step, "Percent"]), 50 )
     cycles = parset.getInt('.'.join(["LoSoTo.Steps", step, "Cycles"]), 3 )
     ncpu = parset.getInt('.'.join(["LoSoTo.Ncpu"]), 1 )
+    taskSize = getParTaskSize( step, parset )
+    executor = getParExecutor( step, parset )
     
     if axesToExt == []:
         logging.error("Please specify at least one axis to extend flag.")
@@ -66,7 +69,7 @@ def run( step, parset, H ):
     for soltab in openSoltabs( H, soltabs ):
 
         # start processes for multi-thread
-        mpm = multiprocManager(ncpu, flag)
+        mpm = multiprocManager(ncpu, flag, executor=executor)
 
         logging.info("Extending flag on soltab: "+soltab._v_name)
 
@@ -86,16 +89,16 @@ def run( step, parset, H ):
                 return 1
 
         # fill the queue (note that sf and sw cannot be put into a queue since they have file references)
-        for vals, weights, coord, selection in sf.getValuesIter(returnAxes=axesToExt, weight=True):
-            mpm.put([weights, coord, axesToExt, selection, percent, size, cycles])
+        # and write the results while they are ready
+        jobs = ([weights, coord, axesToExt, selection, percent, size, cycles] \
+                for vals, weights, coord, selection in sf.getValuesIter(returnAxes=axesToExt, weight=True))
 
-        mpm.wait()
-
-        logging.info('Writing solutions')
-        for w,sel in mpm.get():
+        for w,sel in mpm.map(jobs, taskSize=taskSize):
             sw.selection = sel
             sw.setValues(w, weight=True) # convert back to np.float16
 
+        mpm.wait()
+
         sw.addHistory('FLAG EXTENDED (over %s)' % (str(axesToExt)))
         del sf
         del sw
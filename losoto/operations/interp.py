@@ -16,7 +16,7 @@ def run( step, parset, H ):
     import itertools
     import scipy.interpolate
     import numpy as np
-    from losoto.h5parm import solFetcher, solWriter
+    from losoto.h5parm import solFetcher, solWriter, hdf5Lock
 
     soltabs = getParSoltabs( step, parset, H )
     solTypes = getParSolTypes( step, parset, H )
@@ -91,32 +91,34 @@ def run( step, parset, H ):
             calPoints = np.array([x for x in itertools.product(*calPoints)])
             targetPoints = np.array([x for x in itertools.product(*targetPoints)])
 
-            # interpolation
-            valsNew = scipy.interpolate.griddata(calPoints, calValues, targetPoints, interpMethod)
-
-            # fill values outside boudaries with "nearest" solutions
-            # NOTE: in 1D is useless due to scipy bug but this is compensated in the next if
-            if interpMethod != 'nearest':
-                valsNewNearest = scipy.interpolate.griddata(calPoints, calValues, targetPoints, 'nearest')
-                # NaN is != from itself
-                valsNew[ np.isnan(valsNew) ] = valsNewNearest [ np.isnan(valsNew) ]
-
-            # fix bug in Scipy which put NaNs outside the convex hull in 1D for 'nearest'
-            if len(np.squeeze(vals).shape) == 1:
-                import scipy.cluster.vq as vq
-                valsNew = np.squeeze(valsNew)
-                code, dist = vq.vq(targetPoints, calPoints)
-                # NaN is != from itself
-                valsNew[ np.isnan(valsNew) ] = calValues[code][ np.isnan(valsNew) ]
-                valsNew = valsNew.reshape(vals.shape)
-
-            if rescale:
-                # rescale solutions
-                axis = interpAxes.index(medAxis)
-                valsMed = np.repeat( np.expand_dims( np.median( vals, axis ), axis ), vals.shape[axis], axis )
-                valsNewMed = np.repeat( np.expand_dims( np.median( valsNew, axis ), axis ), valsNew.shape[axis], axis )
-                valsNew = vals*valsNewMed/valsMed
-                #print "Rescaling by: ", valsNewMed[:,0]/valsMed[:,0]
+            # the interpolation does not access the h5parm, other steps can read and write meanwhile
+            with hdf5Lock.released():
+                # interpolation
+                valsNew = scipy.interpolate.griddata(calPoints, calValues, targetPoints, interpMethod)
+
+                # fill values outside boudaries with "nearest" solutions
+                # NOTE: in 1D is useless due to scipy bug but this is compensated in the next if
+                if interpMethod != 'nearest':
+                    valsNewNearest = scipy.interpolate.griddata(calPoints, calValues, targetPoints, 'nearest')
+                    # NaN is != from itself
+                    valsNew[ np.isnan(valsNew) ] = valsNewNearest [ np.isnan(valsNew) ]
+
+                # fix bug in Scipy which put NaNs outside the convex hull in 1D for 'nearest'
+                if len(np.squeeze(vals).shape) == 1:
+                    import scipy.cluster.vq as vq
+                    valsNew = np.squeeze(valsNew)
+                    code, dist = vq.vq(targetPoints, calPoints)
+                    # NaN is != from itself
+                    valsNew[ np.isnan(valsNew) ] = calValues[code][ np.isnan(valsNew) ]
+                    valsNew = valsNew.reshape(vals.shape)
+
+                if rescale:
+                    # rescale solutions
+                    axis = interpAxes.index(medAxis)
+                    valsMed = np.repeat( np.expand_dims( np.median( vals, axis ), axis ), vals.shape[axis], axis )
+                    valsNewMed = np.repeat( np.expand_dims( np.median( valsNew, axis ), axis ), valsNew.shape[axis], axis )
+                    valsNew = vals*valsNewMed/valsMed
+                    #print "Rescaling by: ", valsNewMed[:,0]/valsMed[:,0]
 
             # writing back the solutions
             tw.selection = selection
@@ -14,19 +14,19 @@ def run( step, parset, H ):
     Normalize the solutions to a given value
     """
     import numpy as np
-    from losoto.h5parm import solFetcher, solWriter
+    from losoto.h5parm import solFetcher, solWriter, hdf5Lock
     
     soltabs = getParSoltabs( step, parset, H )
+    threads = getParParallelSoltabs( step, parset )
 
     normVal = parset.getFloat('.'.join(["LoSoTo.Steps", step, "NormVal"]), 1. )
     normAxes = parset.getStringVector('.'.join(["LoSoTo.Steps", step, "NormAxes"]), ['time'] )
 
-    for soltab in openSoltabs( H, soltabs ):
+    def runSoltab(soltab):
 
         logging.info("Normalizing soltab: "+soltab._v_name)
 
         tr = solFetcher(soltab)
-        tw = solWriter(soltab, useCache = True) # remember to flush!
 
         axesNames = tr.getAxesNames()
         for normAxis in normAxes:
@@ -39,21 +39,49 @@ def run( step, parset, H ):
         for axis in tr.getAxesNames():
             userSel[axis] = getParAxis( step, parset, H, axis )
         tr.setSelection(**userSel)
+        tw = solWriter(soltab, useCache = True, **userSel) # remember to flush!
 
-        for vals, weights, coord, selection in tr.getValuesIter(returnAxes=normAxes, weight = True):
+        with hdf5Lock.released():
+            for vals, weights, coord, selection in tr.getValuesIter(returnAxes=normAxes, weight = True):
 
-            # rescale solutions
-            if np.sum(weights) == 0: continue # skip flagged selections
-            valsMean = np.average(vals, weights=weights)
-            vals[weights != 0] *= normVal/valsMean
-            logging.debug(str(coord))
-            logging.debug("Rescaling by: "+str(normVal/valsMean))
+                # rescale solutions
+                if np.sum(weights) == 0: continue # skip flagged selections
+                valsMean = np.average(vals, weights=weights)
+                vals[weights != 0] *= normVal/valsMean
+                logging.debug(str(coord))
+                logging.debug("Rescaling by: "+str(normVal/valsMean))
 
-            # writing back the solutions
-            tw.selection = selection
-            tw.setValues(vals)
+                # writing back the solutions
+                tw.selection = selection
+                tw.setValues(vals)
 
         tw.flush()
         tw.addHistory('NORM (on axis %s)' % (normAxes))
+        return 0
 
-    return 0
+    return runSoltabs( runSoltab, openSoltabs( H, soltabs ), threads )
+
+
+def kernel( step, parset, H, soltab ):
+    """
+    Return the step in fusable form (see losoto.fusion)
+    """
+    import numpy as np
+    from losoto.h5parm import solFetcher
+
+    normVal = parset.getFloat('.'.join(["LoSoTo.Steps", step, "NormVal"]), 1. )
+    normAxes = parset.getStringVector('.'.join(["LoSoTo.Steps", step, "NormAxes"]), ['time'] )
+
+    # errors are reported by run()
+    for normAxis in normAxes:
+        if normAxis not in solFetcher(soltab).getAxesNames(): return None
+
+    def funct(vals, weights, coord, selection):
+        # rescale solutions
+        if np.sum(weights) == 0: return # skip flagged selections
+        valsMean = np.average(vals, weights=weights)
+        vals[weights != 0] *= normVal/valsMean
+        logging.debug(str(coord))
+        logging.debug("Rescaling by: "+str(normVal/valsMean))
+
+    return funct, normAxes, 'NORM (on axis %s)' % (normAxes), None, False
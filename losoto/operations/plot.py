@@ -247,8 +247,8 @@ def run( step, parset, H ):
             
         datatype = sf.getType()
 
-        # start processes for multi-thread
-        mpm = multiprocManager(ncpu, plot)
+        # start processes for multi-thread (matplotlib is not thread safe)
+        mpm = multiprocManager(ncpu, plot, executor='process')
 
         # cycle on files
         if makeMovie: pngs = [] # store png filenames
@@ -15,8 +15,9 @@ def run( step, parset, H ):
    from losoto.h5parm import solWriter
 
    soltabs = getParSoltabs( step, parset, H )
+   threads = getParParallelSoltabs( step, parset )
 
-   for soltab in openSoltabs( H, soltabs ):
+   def runSoltab(soltab):
 
         logging.info("Resetting soltab: "+soltab._v_name)
 
@@ -36,4 +37,21 @@ def run( step, parset, H ):
             t.setValues(0.)
 
         t.addHistory('RESET')
-   return 0
+        return 0
+
+   return runSoltabs( runSoltab, openSoltabs( H, soltabs ), threads )
+
+
+def kernel( step, parset, H, soltab ):
+   """
+   Return the step in fusable form (see losoto.fusion)
+   """
+   from losoto.h5parm import solFetcher
+
+   if solFetcher(soltab).getType() == 'amplitude': resetVal = 1.
+   else: resetVal = 0.
+
+   def funct(vals, weights, coord, selection):
+        vals[...] = resetVal
+
+   return funct, None, 'RESET', None, False
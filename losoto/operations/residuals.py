@@ -94,3 +94,50 @@ def run( step, parset, H ):
         
     return 0
 
+
+
+def kernel( step, parset, H, soltab ):
+    """
+    Return the step in fusable form (see losoto.fusion), only for the tables which are
+    subtracted as a whole (not clock/tec/rm from phases)
+    """
+    import numpy as np
+    from losoto.h5parm import solFetcher
+
+    soltabsToSub = parset.getStringVector('.'.join(["LoSoTo.Steps", step, "Sub"]), [] )
+    ratio = parset.getBool('.'.join(["LoSoTo.Steps", step, "Ratio"]), False )
+
+    if soltabsToSub == []: return None
+
+    # as in run() the last table is the one which is subtracted
+    sf = solFetcher(soltab)
+    ss, st = soltabsToSub[-1].split('/')
+    sfs = solFetcher(H.getSoltab(ss, st), useCache = True)
+    if sf.getType() == 'phase' and (sfs.getType() == 'tec' or sfs.getType() == 'clock' or sfs.getType() == 'rotationmeasure' or sfs.getType() == 'tec3rd' ):
+        return None
+    for soltabToSub in soltabsToSub:
+        ss, st = soltabToSub.split('/')
+        sfsCheck = solFetcher(H.getSoltab(ss, st))
+        for axisName in sfsCheck.getAxesNames():
+            if axisName not in sf.getAxesNames() or \
+                    np.shape(sfsCheck.getAxisValues(axisName)) != np.shape(sf.getAxisValues(axisName)) or \
+                    not all(sfsCheck.getAxisValues(axisName) == sf.getAxisValues(axisName)):
+                return None
+    if sfs.getAxesNames() != sf.getAxesNames(): return None
+
+    for soltabToSub in soltabsToSub:
+        ss, st = soltabToSub.split('/')
+        if sf.getType() != 'phase' and solFetcher(H.getSoltab(ss, st)).getType() in ['tec', 'clock', 'rotationmeasure', 'tec3rd']:
+            logging.warning(soltabToSub+' is of type clock/tec/rm and should be subtracted from a phase. Skipping it.')
+            continue
+        logging.info('Subtracting table: '+soltabToSub)
+
+    def funct(vals, weights, coord, selection):
+        sfs.selection = selection
+        # the iterated axes are squeezed in the slices
+        valsSub = sfs.getValues(retAxesVals=False).reshape(vals.shape)
+        if ratio: vals[...] = (vals - valsSub) / valsSub
+        else: vals[...] = vals - valsSub
+        weights[sfs.getValues(retAxesVals=False, weight=True).reshape(weights.shape) == 0] = 0
+
+    return funct, None, 'RESIDUALS by subtracting tables '+' '.join(soltabsToSub), None, True
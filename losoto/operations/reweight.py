@@ -62,3 +62,49 @@ def run( step, parset, H ):
             sw.setValues(weights, weight=True)
 
    return 0
+
+
+def kernel( step, parset, H, soltab ):
+   """
+   Return the step in fusable form (see losoto.fusion)
+   """
+   from losoto.h5parm import solFetcher
+   import numpy as np
+
+   weightVal = parset.getFloat('.'.join(["LoSoTo.Steps", step, "WeightVal"]), 1. )
+   mergeSoltab = parset.getString('.'.join(["LoSoTo.Steps", step, "MergeFromSoltab"]), '' )
+   flagBad = parset.getBool('.'.join(["LoSoTo.Steps", step, "FlagBad"]), False )
+
+   sf = solFetcher(soltab)
+   userSel = {}
+   for axis in sf.getAxesNames():
+        userSel[axis] = getParAxis( step, parset, H, axis )
+   solType = sf.getType()
+
+   msf = None
+   if mergeSoltab != '':
+        mss, mst = mergeSoltab.split('/')
+        # the whole table is cached and the slices are read from memory
+        msf = solFetcher(H.getSoltab(mss, mst), useCache = True)
+        # the slices are taken by position, so the tables must have the same axes (errors are reported by run())
+        if msf.getAxesNames() != sf.getAxesNames(): return None
+        for axis in sf.getAxesNames():
+            if np.shape(msf.getAxisValues(axis)) != np.shape(sf.getAxisValues(axis)) or \
+                    not np.all(msf.getAxisValues(axis) == sf.getAxisValues(axis)):
+                return None
+        history = 'WEIGHT merged from '+mergeSoltab+' for selection:'+str(userSel)
+   else:
+        history = 'REWEIGHTED to '+str(weightVal)+' for selection:'+str(userSel)
+
+   def funct(vals, weights, coord, selection):
+        if msf is not None:
+            msf.selection = selection
+            # the iterated axes are squeezed in the slices
+            weights[ msf.getValues(retAxesVals = False, weight = True).reshape(weights.shape) == 0 ] = 0.
+        else:
+            weights[...] = weightVal
+        if flagBad:
+            if solType == 'amplitude': weights[vals == 1] = 0
+            else: weights[vals == 0] = 0
+
+   return funct, None, history, None, True
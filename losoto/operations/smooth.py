@@ -9,18 +9,52 @@ from losoto.operations_lib import *
 
 logging.debug('Loading SMOOTH module.')
 
+def smooth(vals, weights, selection, mode, FWHM, outQueue=None):
+    """
+    Smooth the data
+    vals = the data
+    weights = the weights (flagged data are ignored by median and mean)
+    mode = runningmedian, median or mean
+    FWHM = size of the running median along each axis
+
+    return: smoothed data and selection
+    """
+    import scipy.ndimage.filters
+    import numpy as np
+
+    if mode == 'runningmedian':
+        valsnew = scipy.ndimage.filters.median_filter(vals, FWHM)
+    elif mode == 'median':
+        valsnew = np.median( vals[(weights!=0)] )
+    elif mode == 'mean':
+        valsnew = np.mean( vals[(weights!=0)] )
+
+    outQueue.put([valsnew, selection])
+
+
 def run( step, parset, H ):
 
-    import scipy.ndimage.filters
     import numpy as np
-    from losoto.h5parm import solFetcher, solWriter
+    from losoto.h5parm import solFetcher, solWriter, hdf5Lock
 
     soltabs = getParSoltabs( step, parset, H )
+    threads = getParParallelSoltabs( step, parset )
+    memoryLimit = getParMemoryLimit( step, parset )
+    prefetch = getParPrefetch( step, parset )
+    ncpu = parset.getInt('.'.join(["LoSoTo.Ncpu"]), 1 )
+    taskSize = getParTaskSize( step, parset )
+    executor = getParExecutor( step, parset )
+    # with a memory limit the data are sent to the workers through the queues
+    sharedMemory = parset.getBool('.'.join(["LoSoTo.SharedMemory"]), True ) and memoryLimit is None
 
     axesToSmooth = parset.getStringVector('.'.join(["LoSoTo.Steps", step, "Axes"]), [] )
     FWHM = parset.getIntVector('.'.join(["LoSoTo.Steps", step, "FWHM"]), [] )
     mode = parset.getString('.'.join(["LoSoTo.Steps", step, "Mode"]), "runningmedian" )
 
+    if mode != 'runningmedian' and mode != 'median' and mode != 'mean':
+        logging.error('Mode must be: runningmedian, median or mean')
+        return 1
+
     if mode == "runningmedian" and len(axesToSmooth) != len(FWHM):
         logging.error("Axes and FWHM lenghts must be equal.")
         return 1
@@ -31,12 +65,11 @@ def run( step, parset, H ):
     if FWHM != [] and mode != "runningmedian":
         logging.warning("FWHM makes sense only with runningmedian mode, ignoring it.")
 
-    for soltab in openSoltabs( H, soltabs ):
+    def runSoltab(soltab):
 
         logging.info("Smoothing soltab: "+soltab._v_name)
 
         sf = solFetcher(soltab)
-        sw = solWriter(soltab, useCache = True) # remember to flush!
 
         # axis selection
         userSel = {}
@@ -44,31 +77,39 @@ def run( step, parset, H ):
             userSel[axis] = getParAxis( step, parset, H, axis )
         sf.setSelection(**userSel)
 
-        for i, axis in enumerate(axesToSmooth[:]):
+        # with a memory limit the data are written directly on disk, otherwise only the selection is cached
+        sw = solWriter(soltab, useCache = memoryLimit is None, **userSel) # remember to flush!
+
+        # the axes are checked for each soltab, which can be processed at the same time
+        soltabAxes = []
+        soltabFWHM = []
+        for i, axis in enumerate(axesToSmooth):
             if axis not in sf.getAxesNames():
-                del axesToSmooth[i]
-                del FWHM[i]
                 logging.warning('Axis \"'+axis+'\" not found. Ignoring.')
+            else:
+                soltabAxes.append(axis)
+                if i < len(FWHM): soltabFWHM.append(FWHM[i])
 
-        for vals, weights, coord, selection in sf.getValuesIter(returnAxes=axesToSmooth, weight=True):
+        # start processes for multi-thread
+        mpm = multiprocManager(ncpu, smooth, sharedMemory=sharedMemory, executor=executor)
 
-            if mode == 'runningmedian':
-                valsnew = scipy.ndimage.filters.median_filter(vals, FWHM)
-            elif mode == 'median':
-                valsnew = np.median( vals[(weights!=0)] )
-            elif mode == 'mean':
-                valsnew = np.mean( vals[(weights!=0)] )
-            else:
-                logging.error('Mode must be: runningmedian, median or mean')
-                return 1
+        jobs = ([vals, weights, selection, mode, soltabFWHM] \
+                for vals, weights, coord, selection in sf.getValuesIter(returnAxes=soltabAxes, weight=True, \
+                    memoryLimit=memoryLimit, prefetch=prefetch, blockHandler=mpm.share))
+
+        with hdf5Lock.released():
+            for valsnew, selection in mpm.map(jobs, taskSize=taskSize):
+                sw.selection = selection
+                sw.setValues(valsnew)
 
-            sw.selection = selection
-            sw.setValues(valsnew)
+        mpm.wait()
 
-        sw.flush()
-        sw.addHistory('SMOOTH (over %s with mode = %s)' % (axesToSmooth, mode))
+        if sw.useCache: sw.flush()
+        sw.addHistory('SMOOTH (over %s with mode = %s)' % (soltabAxes, mode))
         del sf
         del sw
-    return 0
+        return 0
+
+    return runSoltabs( runSoltab, openSoltabs( H, soltabs ), threads )
 
 
@@ -3,84 +3,449 @@
 
 # Some utilities for operations
 
-import sys
+import os, sys, time
+import atexit
 import logging
-from losoto.h5parm import solFetcher
+import tempfile
+import threading
+import itertools
+import collections
+import traceback
+import Queue
+import numpy as np
+from losoto.h5parm import solFetcher, hdf5Lock
 import multiprocessing
 
-class multiprocManager(object):
+# available backends for the workerPool
+executors = ['process', 'thread', 'serial']
+
+# directory for the shared memory files (tmpfs if available)
+if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK): shmDir = '/dev/shm'
+else: shmDir = tempfile.gettempdir()
+
+# shared memory files not yet removed: path -> pid of the process which created them
+_shmFiles = {}
+
+def _removeShmFiles():
+    """
+    Remove the shared memory files of the managers which never reached wait() (e.g. after an error in a step)
+    """
+    for path, pid in _shmFiles.items():
+        # the forked workers inherit the dict
+        if pid != os.getpid(): continue
+        try: os.unlink(path)
+        except OSError: pass
+        del _shmFiles[path]
+
+atexit.register(_removeShmFiles)
+
+def _encodeShared(obj, roots):
+    """
+    Replace the arrays (or the arrays in a list/tuple) which are views of a shared array with descriptors
+    roots: dict of id(shared array) -> (path, shared array)
+    """
+    if isinstance(obj, (list, tuple)): return type(obj)([_encodeShared(o, roots) for o in obj])
+    if not isinstance(obj, np.ndarray) or roots == {}: return obj
+    base = obj
+    while base is not None and not id(base) in roots: base = base.base
+    if base is None: return obj
+    path, root = roots[id(base)]
+    offset = obj.__array_interface__['data'][0] - root.__array_interface__['data'][0]
+    return ('__shared__', path, root.dtype.str, root.shape, offset, obj.dtype.str, obj.shape, obj.strides)
+
+def _decodeShared(obj, roots):
+    """
+    Replace the descriptors with views of the shared arrays, which are mapped if needed
+    roots: dict of id(shared array) -> (path, shared array)
+    """
+    if isinstance(obj, tuple) and len(obj) == 8 and obj[0] == '__shared__':
+        tag, path, rootDtype, rootShape, offset, dtype, shape, strides = obj
+        root = None
+        for rootPath, rootArray in roots.itervalues():
+            if rootPath == path: root = rootArray
+        if root is None:
+            root = np.memmap(path, dtype=rootDtype, mode='r+', shape=rootShape)
+            roots[id(root)] = (path, root)
+        return np.ndarray(shape, dtype=dtype, buffer=root, offset=offset, strides=strides)
+    if isinstance(obj, (list, tuple)): return type(obj)([_decodeShared(o, roots) for o in obj])
+    return obj
+
+
+def _runJob(outQueue, managerId, funct, parms):
+    """
+    Run a job and send its results (or ('error', id, traceback) if it fails) and then
+    the ('done', id, time) message to the output queue
+    """
+    start = time.time()
+    # shared arrays are mapped only for the time of this job
+    roots = {}
+    try:
+        funct(*_decodeShared(parms, roots), outQueue=workerPool.resultQueue(outQueue, managerId, roots))
+    except:
+        outQueue.put(('error', managerId, traceback.format_exc()))
+    del roots
+    outQueue.put(('done', managerId, time.time()-start))
+
+def _workerLoop(inQueue, outQueue):
+    """
+    Run the jobs from the input queue until the poison pill
+    """
+    while True:
+        job = inQueue.get()
+
+        # poison pill
+        if job is None: break
+
+        _runJob(outQueue, *job)
 
-    class multiThread(multiprocessing.Process):
+
+class workerPool(object):
+    """
+    A pool of workers which runs the jobs of all the multiprocManagers,
+    the results are sent back to the manager which submitted the job.
+    The workers can be:
+    * process: jobs and results are pickled (arrays can be passed in shared memory)
+    * thread: jobs and results are passed without copies, useful when the job releases the GIL (numpy, scipy)
+    * serial: jobs are run in the calling thread when they are submitted
+    """
+
+    class worker(multiprocessing.Process):
         """
-        This class is a working thread which load parameters from a queue and
-        return in the output queue
+        This class is a working process which load jobs from a queue and
+        return their results in the output queue
         """
 
-        def __init__(self, inQueue, outQueue, funct):
+        def __init__(self, inQueue, outQueue):
             multiprocessing.Process.__init__(self)
+            self.daemon = True
             self.inQueue = inQueue
             self.outQueue = outQueue
-            self.funct = funct
 
         def run(self):
+            _workerLoop(self.inQueue, self.outQueue)
 
-            while True:
-                parms = self.inQueue.get()
+    class resultQueue(object):
+        """
+        This class is the output queue given to the parallelized function, it adds the
+        id of the manager to the results
+        """
 
-                # poison pill
-                if parms is None:
-                    self.inQueue.task_done()
-                    break
+        def __init__(self, queue, managerId, roots):
+            self.queue = queue
+            self.managerId = managerId
+            self.roots = roots
 
-                self.funct(*parms, outQueue=self.outQueue)
-                self.inQueue.task_done()
+        def put(self, obj):
+            self.queue.put(('result', self.managerId, _encodeShared(obj, self.roots)))
 
 
-    def __init__(self, procs=1, funct=None):
+    def __init__(self, procs=1, executor='process'):
+        """
+        procs: number of workers
+        executor: process, thread or serial
+        """
+        if executor not in executors:
+            logging.warning('Unknown executor "%s", using "process".' % executor)
+            executor = 'process'
+        self.executor = executor
+        self.procs = procs if executor != 'serial' else 1
+        if executor == 'process':
+            self.inQueue = multiprocessing.Queue()
+            self.outQueue = multiprocessing.Queue()
+        else:
+            self.inQueue = Queue.Queue()
+            self.outQueue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.pending = collections.defaultdict(collections.deque)
+        self.busyTime = 0. # total time spent by the workers on jobs
+        self.nextId = itertools.count()
+
+        self._workers = []
+        if executor == 'serial': return
+        logging.debug('Spawning %i %s workers...' % (self.procs, executor))
+        for proc in xrange(self.procs):
+            if executor == 'process':
+                w = self.worker(self.inQueue, self.outQueue)
+            else:
+                w = threading.Thread(target=_workerLoop, args=(self.inQueue, self.outQueue))
+                w.daemon = True
+            self._workers.append(w)
+            w.start()
+
+    def submit(self, managerId, funct, parms):
         """
-        Manager for multiprocessing
-        procs: number of processors
+        Send a job, with processes funct must be a module level function (it is pickled)
+        """
+        if self.executor == 'serial': _runJob(self.outQueue, managerId, funct, parms)
+        else: self.inQueue.put((managerId, funct, parms))
+
+    def receive(self, managerId):
+        """
+        Wait for the next message (('result', id, result), ('error', id, traceback) or ('done', id, time)) for a manager,
+        messages for other managers are kept for them
+        """
+        with self.lock:
+            while len(self.pending[managerId]) == 0:
+                msg = self.outQueue.get()
+                if msg[0] == 'done': self.busyTime += msg[2]
+                self.pending[msg[1]].append(msg)
+            return self.pending[managerId].popleft()
+
+    def stop(self):
+        """
+        Send poison pills to the workers and wait for them to finish
+        """
+        for w in self._workers:
+            self.inQueue.put(None)
+        for w in self._workers:
+            w.join()
+        self._workers = []
+
+
+def _runBatch(funct, batch, outQueue=None):
+    """
+    Run a function on a batch of parameters (used to group small jobs)
+    """
+    for parms in batch:
+        funct(*parms, outQueue=outQueue)
+
+
+def _nbytes(obj):
+    """
+    Return the size of the arrays in the parameters of a job
+    """
+    if isinstance(obj, (list, tuple)): return sum([_nbytes(o) for o in obj])
+    if isinstance(obj, np.ndarray): return obj.nbytes
+    return 0
+
+
+# the pool shared by all the operations (see startPool())
+_pool = None
+
+def startPool(procs=1, executor='process'):
+    """
+    Start the pool of workers used by all the multiprocManagers
+    procs: number of workers
+    executor: process, thread or serial (see workerPool)
+    """
+    global _pool
+    if _pool is not None: stopPool()
+    _pool = workerPool(procs, executor)
+    return _pool
+
+def getPool():
+    """
+    Return the pool of workers, None if not started
+    """
+    return _pool
+
+def stopPool():
+    """
+    Stop the pool of workers
+    """
+    global _pool
+    if _pool is not None:
+        _pool.stop()
+        _pool = None
+
+
+class multiprocManager(object):
+
+    def __init__(self, procs=1, funct=None, sharedMemory=False, executor=None):
+        """
+        Manager for multiprocessing, the jobs are run by the pool of workers started with startPool()
+        or by a pool owned by the manager if no pool is running (or if it has a different executor)
+        procs: number of processors (if no pool is running)
         funct: function to parallelize / note that the last parameter of this function must be the outQueue
         and it will be linked to the output queue
+        sharedMemory: arrays created with share() (and their views) are passed in shared memory, the workers
+        get writable views of them and results which are views of them are not copied back
+        (only with processes, threads always get the arrays without copies)
+        executor: process, thread or serial (default: the one of the running pool, otherwise process)
         """
-        self.procs = procs
-        self._threads = []
-        self.inQueue = multiprocessing.JoinableQueue()
-        self.outQueue = multiprocessing.Queue()
-        self.runs = 0
-        
-        logging.debug('Spawning %i threads...' % self.procs)
-        for proc in xrange(self.procs):
-            t = self.multiThread(self.inQueue, self.outQueue, funct)
-            self._threads.append(t)
-            t.start()
+        if _pool is None or (executor is not None and executor != _pool.executor):
+            self.pool = workerPool(procs, executor or 'process')
+            self.ownPool = True
+        else:
+            self.pool = _pool
+            self.ownPool = False
+        self.procs = self.pool.procs
+        self.id = self.pool.nextId.next()
+        self.funct = funct
+        self.runs = 0 # jobs not yet completed
+        self._results = collections.deque()
+        self._jobTimes = []
+        self._jobSlices = []
+        self._jobBytes = []
+        self.sharedMemory = sharedMemory and self.pool.executor == 'process'
+        self._shared = {} # id -> (path, shared array)
+
+    def share(self, array):
+        """
+        Return a copy of the array in shared memory (only with sharedMemory=True), its views are then
+        passed to the workers without copies
+        """
+        if not self.sharedMemory or array.size == 0: return array
+        fd, path = tempfile.mkstemp(prefix='losoto_', suffix='.shm', dir=shmDir)
+        os.close(fd)
+        _shmFiles[path] = os.getpid()
+        shared = np.memmap(path, dtype=array.dtype, mode='w+', shape=array.shape)
+        shared[...] = array
+        self._shared[id(shared)] = (path, shared)
+        return shared
 
     def put(self, args):
         """
         Parameters to give to the next jobs sent into queue
         """
-        self.inQueue.put(args)
+        self._jobSlices.append(1)
+        self._jobBytes.append(_nbytes(args))
+        self.pool.submit(self.id, self.funct, _encodeShared(args, self._shared))
         self.runs += 1
 
+    def putBatch(self, batch):
+        """
+        Send a list of parameters as a single job, the function is run on each of them
+        """
+        if len(batch) == 1: return self.put(batch[0])
+        self._jobSlices.append(len(batch))
+        self._jobBytes.append(_nbytes(batch))
+        self.pool.submit(self.id, _runBatch, _encodeShared([self.funct, batch], self._shared))
+        self.runs += 1
+
+    def _receive(self):
+        """
+        Wait for the next message from the pool
+        """
+        # other steps can access the h5parm in the meanwhile (see losoto.scheduler)
+        with hdf5Lock.released(): msg = self.pool.receive(self.id)
+        if msg[0] == 'done':
+            self.runs -= 1
+            self._jobTimes.append(msg[2])
+        elif msg[0] == 'error': self._fail(msg[2])
+        else: self._results.append(_decodeShared(msg[2], self._shared))
+
+    def _fail(self, error):
+        """
+        Wait for the jobs still running, release the workers and the shared memory and raise the error of a job
+        """
+        while self.runs > 0:
+            with hdf5Lock.released(): msg = self.pool.receive(self.id)
+            if msg[0] == 'done': self.runs -= 1
+        self._results.clear()
+        if self.ownPool: self.pool.stop()
+        self._removeShared()
+        raise Exception('Error in a parallel job:\n'+error)
+
     def get(self):
         """
-        Return all the results as an iterator
+        Return all the remaining results as an iterator
         """
-        # NOTE: do not use queue.empty() check which is unreliable
-        # https://docs.python.org/2/library/multiprocessing.html
-        for run in xrange(self.runs):
-            yield self.outQueue.get()
+        while len(self._results) > 0 or self.runs > 0:
+            if len(self._results) == 0: self._receive()
+            else: yield self._results.popleft()
+
+    def map(self, argsIter, window=None, taskSize=None, taskTime=0.5):
+        """
+        Send the jobs from an iterator and return the results as an iterator, while they are ready.
+        At most window jobs are in the queues at any time, so the memory is proportional to the number of processes.
+        Small jobs are grouped: the number of jobs in a group is adapted to the time measured for the
+        jobs already completed, so that a group takes about taskTime.
+        argsIter: iterator over the parameters of the jobs
+        window: maximum number of jobs in the queues (default: 2 times the number of processes)
+        taskSize: maximum size in MB of the arrays in a group of jobs (default: None, no grouping)
+        taskTime: target time in s of a group of jobs (default: 0.5)
+        """
+        if window is None: window = 2*self.procs
+        batch = []
+        batchBytes = 0
+        batchLen = 1
+        for args in argsIter:
+            batch.append(args)
+            batchBytes += _nbytes(args)
+            if taskSize is not None and len(batch) < batchLen and batchBytes < taskSize*1024*1024: continue
+            self.putBatch(batch)
+            batch = []
+            batchBytes = 0
+            while self.runs >= window:
+                self._receive()
+                while len(self._results) > 0: yield self._results.popleft()
+            # time of a single slice from the completed jobs
+            if taskSize is not None and self._jobTimes != []:
+                sliceTime = sum(self._jobTimes) / sum(self._jobSlices[:len(self._jobTimes)])
+                batchLen = max(1, int(taskTime / max(sliceTime, 1e-6)))
+        if batch != []: self.putBatch(batch)
+        for result in self.get():
+            yield result
+
+    def logStats(self):
+        """
+        Log the granularity and the timing of the jobs sent so far
+        """
+        if self._jobTimes == []: return
+        logging.info('Parallel jobs: %i (%.1f slices/job, %.1f kB/job), time per job: min %.3f s, median %.3f s, max %.3f s.' % \
+                (len(self._jobTimes), np.mean(self._jobSlices), np.mean(self._jobBytes)/1024., \
+                np.min(self._jobTimes), np.median(self._jobTimes), np.max(self._jobTimes)))
 
     def wait(self):
         """
-        Send poison pills to jobs and wait for them to finish
-        The join() should kill all the processes
+        Wait for all the jobs to finish, results are kept for get()
         """
-        for t in self._threads:
-            self.inQueue.put(None)
+        while self.runs > 0: self._receive()
+        self.logStats()
 
-        # wait for all jobs to finish
-        self.inQueue.join()
+        if self.ownPool: self.pool.stop()
+        self._removeShared()
+
+    def _removeShared(self):
+        # the shared arrays stay mapped in this process until they are used
+        # (the files of a manager which never reaches wait(), e.g. after an error, are removed at exit)
+        for path, shared in self._shared.itervalues():
+            try: os.unlink(path)
+            except OSError: pass
+            _shmFiles.pop(path, None)
+        self._shared = {}
+
+
+def runSoltabs( funct, soltabs, threads=1 ):
+    """
+    Run funct(soltab) for every soltab and return the highest return code.
+    With threads > 1 the soltabs are processed concurrently: funct runs holding hdf5Lock (so the h5parm
+    is accessed by one thread at a time) and can release it with "with hdf5Lock.released():" around
+    computations which access the data only through getValues(), getValuesIter() and setValues().
+    The lock is also released while waiting for the jobs of a multiprocManager.
+    soltabs: the soltabs (e.g. from openSoltabs())
+    threads: number of soltabs processed at the same time
+    """
+    soltabs = list(soltabs)
+    if threads <= 1 or len(soltabs) <= 1:
+        for soltab in soltabs:
+            returncode = funct(soltab)
+            if returncode: return returncode
+        return 0
+
+    returncodes = []
+    todo = collections.deque(soltabs)
+    def worker():
+        while True:
+            try: soltab = todo.popleft()
+            except IndexError: return
+            try:
+                with hdf5Lock: returncodes.append(funct(soltab))
+            except:
+                logging.error('Error processing soltab %s:\n%s' % (soltab._v_name, traceback.format_exc()))
+                returncodes.append(1)
+
+    logging.info('Processing %i soltabs with %i threads.' % (len(soltabs), min(threads, len(soltabs))))
+    workers = [threading.Thread(target=worker) for i in xrange(min(threads, len(soltabs)))]
+    for w in workers:
+        w.daemon = True
+        w.start()
+    # the threads need the lock, which may be held by this thread (see losoto.scheduler)
+    with hdf5Lock.released():
+        for w in workers: w.join()
+
+    return max([r or 0 for r in returncodes])
 
 
 def getParSolsets( step, parset, H ):
@@ -191,6 +556,105 @@ def getParSolTypes( step, parset, H ):
     return solTypes
 
 
+def getParMemoryLimit( step, parset ):
+    """
+    Return the memory limit (MB) to use when iterating on the data of this step.
+    The order is:
+    * local step value
+    * global value
+    * default = None (all data are read in memory)
+    """
+
+    # local val
+    stepOptName = '.'.join( [ "LoSoTo.Steps", step, "MemoryLimit" ] )
+    memoryLimit = parset.getInt( stepOptName, 0 )
+
+    # global val or default
+    if memoryLimit == 0:
+        memoryLimit = parset.getInt( "LoSoTo.MemoryLimit", 0 )
+
+    if memoryLimit <= 0: return None
+    return memoryLimit
+
+
+def getParTaskSize( step, parset ):
+    """
+    Return the size (MB) of the parallel jobs of this step, small slices of data are grouped up to this size.
+    The order is:
+    * local step value
+    * global value
+    * default = 1
+    """
+
+    # local val
+    stepOptName = '.'.join( [ "LoSoTo.Steps", step, "TaskSize" ] )
+    taskSize = parset.getFloat( stepOptName, 0. )
+
+    # global val or default
+    if taskSize <= 0:
+        taskSize = parset.getFloat( "LoSoTo.TaskSize", 1. )
+
+    if taskSize <= 0: return None
+    return taskSize
+
+
+def getParPrefetch( step, parset ):
+    """
+    Return the number of data blocks to read in background when iterating on the data
+    of this step (used only with a memory limit).
+    The order is:
+    * local step value
+    * global value
+    * default = 0 (no prefetch)
+    """
+
+    # local val
+    stepOptName = '.'.join( [ "LoSoTo.Steps", step, "Prefetch" ] )
+    prefetch = parset.getInt( stepOptName, -1 )
+
+    # global val or default
+    if prefetch < 0:
+        prefetch = parset.getInt( "LoSoTo.Prefetch", 0 )
+
+    return max(0, prefetch)
+
+
+def getParExecutor( step, parset ):
+    """
+    Return the backend (process, thread or serial) used to run the parallel jobs of this step.
+    The order is:
+    * local step value
+    * global value
+    * default = process
+    """
+
+    # local val
+    stepOptName = '.'.join( [ "LoSoTo.Steps", step, "Executor" ] )
+    executor = parset.getString( stepOptName, '' ).lower()
+    if executor != '': return executor
+
+    # global val or default
+    return parset.getString( "LoSoTo.Executor", 'process' ).lower()
+
+
+def getParParallelSoltabs( step, parset ):
+    """
+    Return the number of soltabs processed at the same time by this step (see runSoltabs()).
+    The order is:
+    * local step value
+    * global value
+    * default = False (one soltab at a time)
+    If true the soltabs are processed by LoSoTo.Ncpu threads.
+    """
+
+    # local val or global val or default
+    stepOptName = '.'.join( [ "LoSoTo.Steps", step, "ParallelSoltabs" ] )
+    parallel = parset.getBool( stepOptName, parset.getBool( "LoSoTo.ParallelSoltabs", False ) )
+
+    if not parallel: return 1
+    return parset.getInt( "LoSoTo.Ncpu", 1 )
+
+
 def getParAxis( step, parset, H, axisName ):
     """
     Return the axis val array for this step.
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Run the steps of a parset concurrently when they do not access the same soltabs
+
+import logging
+import threading
+import Queue
+import traceback
+from losoto.h5parm import hdf5Lock
+from losoto.operations_lib import getParSoltabs
+
+# operations which only read their soltabs
+readOps = ['PLOT']
+# operations which modify their soltabs in place
+writeOps = ['ABS', 'CLIP', 'FLAG', 'FLAGEXTEND', 'NORM', 'RESET', 'SMOOTH', 'SMOOTHCLOCK']
+# operations which modify their soltabs and read other soltabs given in a parameter (name, is a vector)
+readParOps = {'INTERP': ('CalSoltab', False), 'RESIDUALS': ('Sub', True), 'REWEIGHT': ('MergeFromSoltab', False)}
+# all the other operations (e.g. those creating soltabs) are run alone
+
+def stepAccess( step, op, parset, H ):
+    """
+    Return the soltabs (in "solset/soltab" form) read and written by a step as (reads, writes)
+    or None if the step must run alone (it creates soltabs or its accesses are unknown)
+    """
+    if op in readOps:
+        soltabs = set(getParSoltabs( step, parset, H ))
+        if op == 'PLOT':
+            soltabs |= set(parset.getStringVector('.'.join(["LoSoTo.Steps", step, "Add"]), [] ))
+        return soltabs, set()
+
+    if op in writeOps:
+        soltabs = set(getParSoltabs( step, parset, H ))
+        return soltabs, soltabs
+
+    if op in readParOps:
+        soltabs = set(getParSoltabs( step, parset, H ))
+        parName, isVector = readParOps[op]
+        stepOptName = '.'.join(["LoSoTo.Steps", step, parName])
+        if isVector: reads = set(parset.getStringVector( stepOptName, [] ))
+        else: reads = set([parset.getString( stepOptName, '' )]) - set([''])
+        return reads | soltabs, soltabs
+
+    return None
+
+
+def conflict( access1, access2 ):
+    """
+    Return True if two steps must run in the order of the parset
+    """
+    reads1, writes1 = access1
+    reads2, writes2 = access2
+    return len(writes1 & (reads2 | writes2)) > 0 or len(writes2 & reads1) > 0
+
+
+class dagScheduler( object ):
+    """
+    Run the steps following the dependencies among them: a step waits for the previous steps
+    which access the same soltabs (if one of them writes), the other steps run concurrently in threads.
+    The h5parm is accessed by one step at a time, a step gives up the access while it waits for
+    its parallel jobs, so the results are identical to the sequential run.
+    Only the parallel jobs and the computations run with hdf5Lock.released() (ABS, CLIP, FLAG, INTERP,
+    NORM, SMOOTH) overlap with other steps: the rest of a step (e.g. all of RESET) holds the lock.
+    """
+
+    def __init__(self, H, parset, maxSteps=1):
+        """
+        H: the h5parm
+        parset: the parset
+        maxSteps: maximum number of steps running at the same time
+        """
+        self.H = H
+        self.parset = parset
+        self.maxSteps = max(1, maxSteps)
+
+    def _runStep(self, runStep, i, step, finished):
+        try:
+            with hdf5Lock: runStep(step)
+        except:
+            logging.error('Error in step \'%s\':\n%s' % (step, traceback.format_exc()))
+        finished.put(i)
+
+    def _runGroup(self, runStep, group):
+        """
+        Run a list of (step, access) which do not create soltabs
+        """
+        # dependencies on the previous steps of the group
+        deps = {}
+        for j, (step, access) in enumerate(group):
+            deps[j] = set([i for i in xrange(j) if conflict(group[i][1], access)])
+            if deps[j] != set():
+                logging.debug('Step \'%s\' waits for: %s' % (step, ', '.join([group[i][0] for i in sorted(deps[j])])))
+
+        finished = Queue.Queue()
+        waiting = range(len(group))
+        running = {}
+        done = set()
+        while waiting != [] or running != {}:
+            # start the ready steps in the order of the parset
+            for j in waiting[:]:
+                if len(running) >= self.maxSteps: break
+                if deps[j] <= done:
+                    thread = threading.Thread(target=self._runStep, args=(runStep, j, group[j][0], finished))
+                    thread.daemon = True
+                    running[j] = thread
+                    waiting.remove(j)
+                    thread.start()
+            i = finished.get()
+            running.pop(i).join()
+            done.add(i)
+
+    def run(self, steps, ops, runStep):
+        """
+        steps: list of step names
+        ops: dict of known operations
+        runStep: function running a step
+        """
+        group = []
+        for step in steps:
+            op = self.parset.getString( '.'.join( [ "LoSoTo.Steps", step, "Operation" ] ) )
+            # the soltabs are found when all the steps which may create them have run
+            access = None
+            if op in ops:
+                with hdf5Lock: access = stepAccess( step, op, self.parset, self.H )
+            if access is not None:
+                group.append((step, access))
+                continue
+
+            # steps which must run alone
+            self._runGroup(runStep, group)
+            group = []
+            with hdf5Lock: runStep(step)
+
+        self._runGroup(runStep, group)
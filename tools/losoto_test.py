@@ -7,14 +7,15 @@
 # Francesco de Gasperin
 _author = "Francesco de Gasperin (fdg@hs.uni-hamurg.de)"
 
-import sys, os, time
+import sys, os, time, threading
 import numpy as np
 import logging
 import losoto._version
 import losoto._logging
-from losoto.h5parm import h5parm, solFetcher, solWriter
+from losoto.h5parm import h5parm, solFetcher, solWriter, startWorkingSet, stopWorkingSet, verifyChecksums, hdf5Lock
 
 if os.path.isfile('test.h5'): os.system('rm test.h5')
+if os.path.isfile('test_repack.h5'): os.system('rm test_repack.h5')
 
 # general h5parm library
 logging.info("Create a new H5parm")
@@ -49,12 +50,16 @@ print "###########################################"
 logging.info('### solTabs')
 axesVals = [['a','b','c','d'], np.arange(10), np.arange(100)]
 vals = np.arange(4*10*100).reshape(4,10,100)
-logging.info("Create soltab")
-H5.makeSoltab(ss, 'amplitude', 'stTest', axesNames=['axis1','axis2','axis3'], axesVals=axesVals, vals=vals, weights=vals)
+logging.info("Create soltab (with checksums)")
+H5.makeSoltab(ss, 'amplitude', 'stTest', axesNames=['axis1','axis2','axis3'], axesVals=axesVals, vals=vals, weights=vals, checksums=True)
 logging.info("Create soltab (using same name)")
 H5.makeSoltab(ss, 'amplitude', 'stTest', axesNames=['axis1','axis2','axis3'], axesVals=axesVals, vals=vals, weights=vals)
 logging.info("Create soltab (using default name)")
 H5.makeSoltab(ss, 'amplitude', axesNames=['axis1','axis2','axis3'], axesVals=axesVals, vals=vals, weights=vals)
+logging.info("Create soltab (using custom chunk shape)")
+H5.makeSoltab(ss, 'amplitude', 'stTestChunk', axesNames=['axis1','axis2','axis3'], axesVals=axesVals, vals=vals, weights=vals, chunkShape=[1,5,100])
+logging.info('Get chunk shapes (exp: (4, 10, 100) and (1, 5, 100))')
+print H5.getSoltab(ss,'stTest').val.chunkshape, H5.getSoltab(ss,'stTestChunk').val.chunkshape
 logging.info('Get a soltab object')
 st=H5.getSoltab(ss,'stTest')
 logging.info('Get all soltabs:')
@@ -93,6 +98,53 @@ logging.info('Writing back with selction')
 Hsw.setSelection(axis1=['f','e','h'], axis2=1, axis3=[1,10])
 Hsw.setValues(v)
 
+logging.info('Set a selection using three lists (exp: 2x3x3 and True)')
+Hsf.setSelection(axis1=['e','h'], axis2=[1,2,8], axis3=[1,50,99])
+v = Hsf.getValues(retAxesVals=False)
+print v.shape
+print (v == vals[np.ix_([0,3],[1,2,8],[1,50,99])]).all()
+logging.info('Writing back with three lists (exp: True)')
+Hsw.setSelection(axis1=['e','h'], axis2=[1,2,8], axis3=[1,50,99])
+Hsw.setValues(-v)
+print (Hsf.getValues(retAxesVals=False) == -v).all()
+Hsw.setValues(v)
+logging.info('Writing back with a cache of the selection only (exp: True True)')
+Hswc = solWriter(st, useCache=True, axis1=['e','h'], axis2=[1,2,8])
+Hswc.selection = list(Hsw.selection)
+Hswc.setValues(-v)
+Hswc.flush()
+print (Hsf.getValues(retAxesVals=False) == -v).all(), Hswc.cacheDirty['weight'] is None and Hswc.cache['weight'] is None
+Hsw.setValues(v)
+logging.info('Writing through the working set, on disk only when flushed (exp: True False True)')
+onDisk = st.val.read()
+startWorkingSet(10)
+Hsw.setValues(-v)
+print (Hsf.getValues(retAxesVals=False) == -v).all(), (st.val.read() != onDisk).any(),
+stopWorkingSet()
+print (st.val.read() != onDisk).any()
+Hsw.setValues(v)
+logging.info('Checksums of the blocks after the writes, a direct write is detected (exp: [] [] True)')
+print verifyChecksums(st.val), verifyChecksums(st.weight),
+st.val[0,0,0] += 1
+print verifyChecksums(st.val) != []
+st.val[0,0,0] -= 1
+logging.info('Lazy snapshot of a soltab, unchanged by a write to the soltab (exp: True False)')
+onDisk = st.val.read()
+stSnap = H5.snapshotSoltab(ss, 'stTest', outSoltab='stTestSnap', lazy=True)
+Hsw.setValues(v+1)
+print (stSnap.val.read() == onDisk).all(), (st.val.read() == onDisk).all()
+Hsw.setValues(v)
+H5.delSoltab(ss, 'stTestSnap')
+logging.info('Values read through a memory map, unchanged by a later write (exp: True)')
+H5mm = h5parm('test_mm.h5', readonly=False, complevel=0)
+stMm = H5mm.makeSoltab(H5mm.makeSolset('ssTest'), 'amplitude', axesNames=['axis1'], axesVals=[['a','b','c']], vals=np.ones(3), weights=np.ones(3))
+vMm = solFetcher(stMm).getValues(retAxesVals=False)
+solWriter(stMm).setValues(5.)
+solFetcher(stMm).getValues(retAxesVals=False)
+print (vMm == 1).all()
+H5mm.close()
+os.system('rm test_mm.h5')
+
 logging.info('Set a selection using min max (exp: 4x4x10)')
 Hsf.setSelection(axis1='e', axis2={'min':2,'max':5}, axis3={'min':90, 'max':1e6})
 v,a = Hsf.getValues()
@@ -102,6 +154,13 @@ logging.info('Writing back with selction')
 Hsw.setSelection(axis1='e', axis2={'min':2,'max':5}, axis3={'min':90, 'max':1e6})
 Hsw.setValues(v)
 
+logging.info('Set a selection using multiple ranges and a tolerance (exp: 4x4x10 and True)')
+Hsf.setSelection(axis2=[{'min':0,'max':1}, {'min':8.1, 'tol':0.2}], axis3={'min':10.05, 'max':18.95, 'tol':0.1})
+v = Hsf.getValues(retAxesVals=False)
+print v.shape
+print (v == vals[np.ix_(range(4),[0,1,8,9],range(10,20))]).all()
+Hsf.setSelection(axis1='e', axis2={'min':2,'max':5}, axis3={'min':90, 'max':1e6})
+
 logging.info('Get Vaues Iter (exp: 40 and 10)')
 i=0
 for matrix, coord, sel in Hsf.getValuesIter(returnAxes=['axis3']):
@@ -114,6 +173,32 @@ for matrix, coord, sel in Hsf.getValuesIter(returnAxes=['axis2','axis3']):
     print coord
     i += 1
 print "Iterations:", i
+logging.info('Get Vaues Iter with a memory limit (exp: 4 and True)')
+i=0
+for (matrix, coord, sel), (matrix2, coord2, sel2) in zip(Hsf.getValuesIter(returnAxes=['axis3'], memoryLimit=1e-4), Hsf.getValuesIter(returnAxes=['axis3'])):
+    if not (matrix == matrix2).all() or sel != sel2: break
+    i += 1
+print "Iterations:", i, i == 4
+logging.info('Get Vaues Iter with prefetch, closed after the first of 3 blocks (exp: True)')
+g = solFetcher(st, axis1='e', axis2=[2,3,4]).getValuesIter(returnAxes=['axis3'], memoryLimit=1e-4, prefetch=2)
+g.next()
+time.sleep(0.5) # the queue is full and the prefetch thread is done
+g.close()
+print threading.active_count() == 1
+logging.info('Get Vaues Iter with prefetch, error while reading (exp: Read error after 1 blocks)')
+def failingHandler(vals, reads=[]):
+    reads.append(1)
+    if len(reads) > 1: raise IOError('Read error')
+    return vals
+i=0
+try:
+    for matrix, coord, sel in Hsf.getValuesIter(returnAxes=['axis3'], memoryLimit=1e-4, prefetch=2, blockHandler=failingHandler):
+        i += 1
+except IOError, e:
+    print e, "after", i, "blocks"
+logging.info('Get Vaues Iter with prefetch holding the h5parm lock, read without prefetch (exp: 4)')
+with hdf5Lock:
+    print len(list(Hsf.getValuesIter(returnAxes=['axis3'], memoryLimit=1e-4, prefetch=2)))
 
 
 print "###########################################"
@@ -126,9 +211,22 @@ print Hsw.getHistory()
 logging.info('printInfo()')
 print H5.printInfo()
 
+logging.info('Set history while val is shared with a lazy snapshot')
+H5.snapshotSoltab(ss, 'stTest', outSoltab='stTestSnap', lazy=True)
+Hsw.addHistory('History of a shared soltab.')
+st._v_attrs['testAttr'] = 'kept'
+history = Hsw.getHistory()
+
 # close the H5parm file
 del Hsf
 del Hsw
-del H5
-os.system('rm test.h5')
+H5.close()
+
+logging.info('Repack, the soltab attributes and the history are kept (exp: True True)')
+os.system(sys.executable+' '+os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin', 'H5parm_repack.py')+' test.h5 test_repack.h5 > /dev/null 2>&1')
+H5 = h5parm('test_repack.h5', readonly=True)
+stRepack = H5.getSoltab('ssTest', 'stTest')
+print solFetcher(stRepack).getHistory().startswith(history), stRepack._v_attrs['testAttr'] == 'kept'
+H5.close()
+os.system('rm test.h5 test_repack.h5')
 logging.info('Done.')